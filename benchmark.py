@@ -0,0 +1,223 @@
+""" Benchmarks every available engine on the workloads that exist
+in this repository and writes the results to a JSON baseline, so
+that interpreter and codegen changes can be compared run to run.
+
+  python benchmark.py [--repeat 3] [--output benchmark.json]
+                      [--compare old-benchmark.json] [--layout default]
+                      [--optimize-sm]
+
+`--layout` picks one of `brain_machine.LAYOUTS` to generate the BF
+code for, so layouts can be compared on the same SM code. Workloads
+that a layout can't generate are skipped. `--optimize-sm` runs the
+SM code through `sm_optimizer.optimize` first.
+
+Every measurement runs in a fresh process, so the peak memory
+reported is that of a single engine on a single workload.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import bf_batch
+import lisp
+import sm_optimizer
+import stack_machine
+from bf import Brainfuck, PROFILE_ANNOTATIONS
+from bf_compiler import CompiledBrainfuck
+from brain_machine import LAYOUTS, sm_to_brainfuck
+
+# Index of the first user variable, right after REG_A to REG_D.
+USR_MEM_START = 4
+
+def countdown_workload():
+  """ The example of stack_machine.py. Its variable names are turned
+  into addresses, and its absolute jumps into the structured jumps
+  that `sm_to_brainfuck` expects. """
+  sm_code = []
+  for cmd, arg in stack_machine.code:
+    if cmd in ('load', 'store'):
+      arg = USR_MEM_START + stack_machine.vars[arg]
+    elif cmd in ('jfz', 'jbnz'):
+      arg = None
+    sm_code.append((cmd, arg))
+  return sm_code, len(stack_machine.vars), 4
+
+def pointers_workload():
+  """ examples/pointers.py, which is written against lisp.py. """
+  namespace = dict(vars(lisp))
+  # `lisp.a` looks names up in the `addr` of lisp.py, not the example's
+  namespace['a'] = lambda var: namespace['addr'][var]
+  execfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'pointers.py'), namespace)
+  return namespace['code'], len(namespace['addr']), 8
+
+def bf_in_bf_workload():
+  return lisp.bf_in_bf_code, len(lisp.addr), 20
+
+WORKLOADS = [
+  ('countdown', countdown_workload),
+  ('pointers', pointers_workload),
+  ('bf_in_bf', bf_in_bf_workload),
+]
+
+def run_interpreter(code, cache_dir):
+  machine = Brainfuck(code)
+  return machine, machine.run
+
+def run_compiled(code, cache_dir):
+  machine = CompiledBrainfuck(code, cache_dir=cache_dir)
+  return machine, machine.run
+
+def run_batch(code, cache_dir):
+  machine = bf_batch.BatchBrainfuck(code, [[]])
+  return machine, machine.run
+
+ENGINES = [
+  ('interpreter', run_interpreter),
+  ('compiled', run_compiled),
+]
+if bf_batch.np is not None:
+  ENGINES.append(('batch', run_batch))
+
+def machine_output(machine):
+  if isinstance(machine, bf_batch.BatchBrainfuck):
+    return machine.outputs[0]
+  return machine.output
+
+def generate(workload, layout, optimize_sm=False):
+  sm_code, usr_mem_size, stack_size = dict(WORKLOADS)[workload]()
+  start = time.time()
+  if optimize_sm:
+    sm_code = sm_optimizer.optimize(sm_code)
+  code = sm_to_brainfuck(sm_code, usr_mem_size, stack_size, layout=LAYOUTS[layout](stack_size))
+  return code, time.time() - start
+
+def reference(workload, layout, optimize_sm=False):
+  """ Counts the BF steps and records the output of a workload with
+  the profiling interpreter. """
+  code, codegen_time = generate(workload, layout, optimize_sm)
+  machine = Brainfuck(code, profile=PROFILE_ANNOTATIONS)
+  machine.run()
+  return {
+    'code_size': len(machine.code),
+    'codegen_time': codegen_time,
+    'steps': sum(machine.execution_log),
+    'output': machine.output
+  }
+
+def measure(workload, engine, repeat, layout, optimize_sm=False):
+  """ Runs in a worker process of its own. """
+  code, _ = generate(workload, layout, optimize_sm)
+  make = dict(ENGINES)[engine]
+  cache_dir = tempfile.mkdtemp()
+  try:
+    # the first construction compiles from scratch
+    start = time.time()
+    machine, run = make(code, cache_dir)
+    compile_time = time.time() - start
+
+    wall_times = []
+    for i in xrange(repeat):
+      if i:
+        machine, run = make(code, cache_dir)
+      start = time.time()
+      run()
+      wall_times.append(time.time() - start)
+  finally:
+    shutil.rmtree(cache_dir)
+
+  return {
+    'compile_time': compile_time,
+    'wall_time': min(wall_times),
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'output': machine_output(machine)
+  }
+
+def measure_in_fresh_process(workload, engine, repeat, layout, optimize_sm=False):
+  pool = multiprocessing.Pool(1)
+  try:
+    return pool.apply(measure, (workload, engine, repeat, layout, optimize_sm))
+  finally:
+    pool.close()
+    pool.join()
+
+def benchmark(repeat, layout='default', optimize_sm=False):
+  results = []
+  for workload, _ in WORKLOADS:
+    try:
+      ref = reference(workload, layout, optimize_sm)
+    except Exception as e:
+      print 'skipping %s: %s' % (workload, e)
+      continue
+    for engine, _ in ENGINES:
+      result = measure_in_fresh_process(workload, engine, repeat, layout, optimize_sm)
+      results.append({
+        'workload': workload,
+        'engine': engine,
+        'layout': layout,
+        'code_size': ref['code_size'],
+        'steps': ref['steps'],
+        'codegen_time': ref['codegen_time'],
+        'compile_time': result['compile_time'],
+        'wall_time': result['wall_time'],
+        'steps_per_second': ref['steps'] / result['wall_time'] if result['wall_time'] else None,
+        'peak_rss_kb': result['peak_rss_kb'],
+        'output_ok': result['output'] == ref['output']
+      })
+  return results
+
+def print_results(results, baseline=None):
+  previous = {}
+  if baseline:
+    for r in baseline['results']:
+      previous[(r['workload'], r['engine'])] = r
+
+  print '%-10s %-12s %9s %10s %9s %9s %12s %9s %3s' % (
+    'workload', 'engine', 'code', 'steps', 'compile', 'wall', 'steps/s', 'rss kb', 'ok')
+  for r in results:
+    line = '%-10s %-12s %9d %10d %8.3fs %8.3fs %12.0f %9d %3s' % (
+      r['workload'], r['engine'], r['code_size'], r['steps'], r['compile_time'],
+      r['wall_time'], r['steps_per_second'] or 0, r['peak_rss_kb'],
+      'yes' if r['output_ok'] else 'NO')
+
+    old = previous.get((r['workload'], r['engine']))
+    if old:
+      line += '   wall x%.2f, steps x%.2f, code x%.2f' % (
+        r['wall_time'] / old['wall_time'], float(r['steps']) / old['steps'],
+        float(r['code_size']) / old['code_size'])
+    print line
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the BF engines.')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best is kept')
+  parser.add_argument('--output', default='benchmark.json', help='where to write the JSON results')
+  parser.add_argument('--compare', help='a previous JSON result to compare against')
+  parser.add_argument('--layout', default='default', choices=sorted(LAYOUTS), help='the memory layout of the generated code')
+  parser.add_argument('--optimize-sm', action='store_true', help='optimize the SM code before generating BF')
+  args = parser.parse_args()
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+
+  results = benchmark(args.repeat, args.layout, args.optimize_sm)
+  print_results(results, baseline)
+
+  with open(args.output, 'w') as f:
+    json.dump({
+      'python': sys.version,
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'repeat': args.repeat,
+      'layout': args.layout,
+      'optimize_sm': args.optimize_sm,
+      'results': results
+    }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
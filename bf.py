@@ -1,46 +1,165 @@
+import bisect
+import os
+import sys
 import time
+from array import array
+
+from snapshot import program_hash, save_state, load_state
+from streams import InputStream, NoInputLeft
+
+# Opcodes of the pre-decoded instruction stream. Every op is an
+# `(op, count)` tuple, where `count` is the (signed) length of the
+# run of identical symbols it replaces.
+OP_MOVE = 0  # < and >
+OP_ADD = 1   # + and -
+OP_JFZ = 2   # [
+OP_JBNZ = 3  # ]
+OP_PRINT = 4 # .
+OP_READ = 5  # ,
+OP_SCAN = 6  # [>>>], [<<<] and other [<{k}] / [>{k}] loops
+
+SYMBOLS = '<>+-.,[]'
+
+# Bump when `_compile` decodes differently, so that decoded programs
+# cached by an older version are not picked up.
+DECODER_VERSION = 2
+
+# Profiling modes
+PROFILE_OFF = 'off'                 # nothing is counted
+PROFILE_ANNOTATIONS = 'annotations' # exact step counts per annotated block
+PROFILE_SAMPLED = 'sampled'         # the op pointer is sampled every N ops
+
+# Yielded by `Brainfuck.run_cooperative` when `,` finds no input.
+WAITING_FOR_INPUT = 'waiting_for_input'
+
+# Tape modes
+CHECKED = 'checked'     # out of range values raise an exception
+WRAPPING = 'wrapping'   # values wrap around modulo 2 ** cell_width
+UNCHECKED = 'unchecked' # values are never checked nor wrapped
+
+CELL_TYPECODES = {16: 'H', 32: 'I'}
+
+def new_tape(size, cell_width=8, mode=CHECKED):
+  """ Returns a zeroed tape of `size` cells.
+
+  Checked and wrapping tapes are compact typed storage: a
+  `bytearray` for 8 bit cells, an `array` otherwise. The storage
+  itself rejects values out of the cell range, which is what makes
+  checked mode free of per-step range checks. Unchecked tapes are
+  plain lists, so cells can hold any integer.
+  """
+  if mode not in (CHECKED, WRAPPING, UNCHECKED):
+    raise Exception('unknown tape mode: ' + str(mode))
+  if mode == UNCHECKED:
+    return [0] * size
+  if cell_width == 8:
+    return bytearray(size)
+  if cell_width not in CELL_TYPECODES:
+    raise Exception('unsupported cell width: ' + str(cell_width))
+  return array(CELL_TYPECODES[cell_width], [0]) * size
+
+def grow_tape(memory, size):
+  """ Grows the tape in place to at least `size` cells, at least
+  doubling it so that growing stays amortized O(1).
+  """
+  missing = max(size, len(memory) * 2) - len(memory)
+  if isinstance(memory, bytearray):
+    memory.extend(bytearray(missing))
+  elif isinstance(memory, array):
+    memory.extend(array(memory.typecode, [0]) * missing)
+  else:
+    memory.extend([0] * missing)
+
+def scan_zero(memory, pointer, stride):
+  """ Returns the number of `stride` sized steps needed to get
+  from `pointer` to the first zero cell, in one strided search
+  over the memory instead of one loop iteration per step.
+
+  Cells past the right end of the tape count as zero, since the
+  tape grows with zeros on demand.
+  """
+  if pointer >= len(memory):
+    # the slice would start at the last cell instead
+    return 0
+  cells = memory[pointer::stride]
+  if isinstance(cells, bytearray):
+    steps = cells.find(b'\x00')
+  else:
+    try:
+      steps = cells.index(0)
+    except ValueError:
+      steps = -1
+
+  if steps != -1:
+    return steps
+  if stride > 0:
+    # first step that lands past the end of the tape
+    return max(0, (len(memory) - pointer + stride - 1) // stride)
+  raise IndexError('no zero cell found, scan ran off the tape')
+
+def split_annotated_line(line):
+  """ Splits a line like `push_5: ++---+.` into its annotation and
+  its code. Either of them can be empty. """
+  for code_start, symbol in enumerate(line):
+    if symbol in SYMBOLS:
+      break
+  else:
+    code_start = len(line)
+  return line[:code_start].strip(), line[code_start:].strip()
 
 class Brainfuck(object):
-  def __init__(self, code):
-    self.instruction_methods = {
-      '<': 'left',
-      '>': 'right',
-      '+': 'inc',
-      '-': 'dec',
-      '.': 'print',
-      ',': 'read',
-      '[': 'jfz',
-      ']': 'jbnz'
-    }
-
-    self.memory = [0] * (50 * 3)
+  def __init__(self, code, cell_width=8, mode=CHECKED, tape_size=50 * 3,
+               profile=PROFILE_OFF, sample_interval=1000, cache_dir=None):
+    self.cell_width = cell_width
+    self.mode = mode
+    self.tape_size = tape_size
+    self.profile = profile
+    self.sample_interval = sample_interval
+    self.annotations = [] # (start, text)
+
+    if cache_dir is None:
+      self._load_annotated_code(code)
+      self._compile()
+    else:
+      self._load_cached_program(code, cache_dir)
+
+    self.program_hash = program_hash(self.code)
+    self.reset()
+
+  def reset(self):
+    """ Puts the machine back into its initial state. The decoded
+    program is kept, so it can be run again without reparsing.
+    """
+    self.memory = new_tape(self.tape_size, self.cell_width, self.mode)
     self.pointer = 0
     self.code_pointer = 0
+    self.op_pointer = 0
     self.input = []
+    self.input_stream = None
     self.output = []
-    self.annotations = [] # (start, text)
-    self.bracket_map = {}
+    # the counters are only allocated for the profile that fills them
+    counting = self.profile == PROFILE_ANNOTATIONS
+    self.op_log = [0] * len(self.ops) if counting else None
+    self.execution_log = [0] * len(self.code) if counting else []
+    self.samples = [0] * len(self.ops) if self.profile == PROFILE_SAMPLED else None
     self.start_time = 0
     self.end_time = 0
 
-    self._load_annotated_code(code)
-    self._map_brackets()
-
-    self.execution_log = [0] * len(self.code)
-
   def __str__(self):
     print 'output:', self.output
     print 't:', (self.end_time - self.start_time) * 1000, 'ms'
     print
     print 'input:', self.input
+    print 'input offset:', self.input_stream.offset if self.input_stream else 0
     print 'pointer:', self.pointer
     print 'code pointer:', self.code_pointer
     print 'code length:', len(self.code)
-    print 'executed instructions:', sum(self.execution_log)
+    if self.profile == PROFILE_ANNOTATIONS:
+      print 'executed instructions:', sum(self.execution_log)
     
     print 'memory:'
     for i in xrange(0, len(self.memory), 3):
-      print self.memory[i:i+3],
+      print list(self.memory[i:i+3]),
       if i == 0:
         print '\tREG_A',
       elif i == 3:
@@ -67,26 +186,27 @@ class Brainfuck(object):
     that the BF code is executing.
 
     Generate source maps basically.
+
+    The code can also be an iterable of chunks of whole lines, such
+    as the output of `brain_machine.iter_brainfuck` or an open file,
+    so it never has to be in memory as one string.
     """
-    code = code.strip()
+    if isinstance(code, basestring):
+      lines = code.strip().split('\n')
+    else:
+      lines = (line for chunk in code for line in chunk.split('\n'))
 
     # temporarily convert to array
     self.code = []
 
     current_code_length = 0
 
-    for l_num, line in enumerate(code.split('\n')):
+    for l_num, line in enumerate(lines):
       if not line or line.isspace():
           continue
-      for sym_num, symbol in enumerate(line):
-        # find start of code
-        if symbol in self.instruction_methods:
-          code_start = sym_num
-          break
 
       # separete annotation and code
-      annotation = line[:code_start].strip()
-      code = line[code_start:].strip()
+      annotation, code = split_annotated_line(line)
 
       # push code and annotations
       self.code.append(code)
@@ -95,73 +215,384 @@ class Brainfuck(object):
 
     self.code = ''.join(self.code)
 
-  def _decode_and_execute(self, symbol):
-    method_name = self.instruction_methods[symbol]
-    method = getattr(self, 'i_' + method_name)
-    method()
-  
-  def _map_brackets(self):
+
+  def _compile(self):
+    """ Pre-decodes the code into a list of `(op, count)` tuples,
+    fusing runs of the same symbol, so that `>>>` becomes
+    `(OP_MOVE, 3)` and `---` becomes `(OP_ADD, -3)`.
+
+    Brackets are never fused, and neither is `,`: a read that finds
+    no input is retried, which must not repeat the reads before it. Their targets are stored in the
+    flat `jump_targets` list, which is parallel to `ops`. A loop
+    with nothing but a pointer move inside, e.g. `[>>>]`, gets its
+    `[` replaced with `(OP_SCAN, stride)`.
+    """
+    code = self.code
+    self.ops = []
+    self.jump_targets = []
+    self.op_positions = [] # op index -> code position
+
     stack = []
-    for i, char in enumerate(self.code):
-      if char == '[':
-        stack.append(i)
-      elif char == ']':
+    i = 0
+    while i < len(code):
+      symbol = code[i]
+      start = i
+      i += 1
+      if symbol not in '[],':
+        while i < len(code) and code[i] == symbol:
+          i += 1
+      count = i - start
+
+      op_index = len(self.ops)
+      target = -1
+
+      if symbol == '>':
+        op = (OP_MOVE, count)
+      elif symbol == '<':
+        op = (OP_MOVE, -count)
+      elif symbol == '+':
+        op = (OP_ADD, count)
+      elif symbol == '-':
+        op = (OP_ADD, -count)
+      elif symbol == '.':
+        op = (OP_PRINT, count)
+      elif symbol == ',':
+        op = (OP_READ, count)
+      elif symbol == '[':
+        op = (OP_JFZ, 1)
+        stack.append(op_index)
+      else:
+        op = (OP_JBNZ, 1)
         if len(stack) == 0:
           raise Exception('Closing parenthesis is missing')
-        start, stop = stack.pop(), i
-        self.bracket_map[start] = stop
-        self.bracket_map[stop] = start
+        target = stack.pop()
+        self.jump_targets[target] = op_index
+        if op_index - target == 2 and self.ops[target + 1][0] == OP_MOVE:
+          self.ops[target] = (OP_SCAN, self.ops[target + 1][1])
+
+      self.ops.append(op)
+      self.jump_targets.append(target)
+      self.op_positions.append(start)
+
     if len(stack):
       raise Exception('Opening parenthesis is missing')
 
-  def i_left(self):
-    self.pointer -= 1
-    self.code_pointer += 1
-
-  def i_right(self):
-    self.pointer += 1
-    self.code_pointer += 1
-
-  def i_inc(self):
-    self.memory[self.pointer] += 1
-    if self.memory[self.pointer] > 255:
-      print self
-      raise Exception('overflow')
-    self.code_pointer += 1
-
-  def i_dec(self):
-    self.memory[self.pointer] -= 1
-    if self.memory[self.pointer] < 0:
-      print self
-      raise Exception('underflow')
-    self.code_pointer += 1
-
-  def i_print(self):
-    self.output.append(self.memory[self.pointer])
-    self.code_pointer += 1
-  
-  def i_read(self):
-    self.memory[self.pointer] = self.input.pop(0)
-    self.code_pointer += 1
-
-  def i_jfz(self):
-    if self.memory[self.pointer] == 0:
-      destination = self.bracket_map[self.code_pointer]
-      self.code_pointer = destination
+    # sentinel, the position right after the last op
+    self.op_positions.append(len(code))
+
+  def _load_cached_program(self, code, cache_dir):
+    """ Loads the decoded program from `cache_dir`, so that it
+    isn't parsed and mapped again. On a miss the program is decoded
+    and saved there.
+    """
+    if not isinstance(code, basestring):
+      code = ''.join(code) # the cache is keyed by the code itself
+    path = os.path.join(cache_dir, '%s.%d.program' % (program_hash(code), DECODER_VERSION))
+    if os.path.exists(path):
+      program = load_state(path)
+      self.code = program['code']
+      self.annotations = program['annotations']
+      self.ops = program['ops']
+      self.jump_targets = program['jump_targets']
+      self.op_positions = program['op_positions']
+      return
+
+    self._load_annotated_code(code)
+    self._compile()
+    save_state(path, {
+      'code': self.code,
+      'annotations': self.annotations,
+      'ops': self.ops,
+      'jump_targets': self.jump_targets,
+      'op_positions': self.op_positions
+    })
+
+  def snapshot(self, path):
+    """ Saves the execution state to `path`: the tape, the
+    pointers, the consumed input offset, the output so far and the
+    hash of the program the state belongs to. Output that already
+    went to a `streams.OutputSink` is only counted.
+    """
+    if isinstance(self.memory, array):
+      tape = self.memory.tostring()
+    elif isinstance(self.memory, bytearray):
+      tape = bytes(self.memory)
+    else:
+      tape = list(self.memory)
+
+    if isinstance(self.output, list):
+      output, output_count = self.output, len(self.output)
+    else:
+      output, output_count = None, self.output.count
+
+    save_state(path, {
+      'program_hash': self.program_hash,
+      'cell_width': self.cell_width,
+      'mode': self.mode,
+      'byteorder': sys.byteorder,
+      'tape': tape,
+      'pointer': self.pointer,
+      'op_pointer': self.op_pointer,
+      'input_offset': self.input_stream.offset if self.input_stream else 0,
+      'output': output,
+      'output_count': output_count,
+      'op_log': self.op_log if self.profile == PROFILE_ANNOTATIONS else None
+    })
+
+  def restore(self, path, input=None):
+    """ Restores an execution state saved with `snapshot`. The
+    already consumed part of `input` (or of the current input, if
+    `input` is None) is skipped. """
+    state = load_state(path)
+    if state['program_hash'] != self.program_hash:
+      raise Exception('snapshot belongs to a different program')
+    if (state['cell_width'], state['mode']) != (self.cell_width, self.mode):
+      raise Exception('snapshot has a different tape format')
+
+    memory = new_tape(0, self.cell_width, self.mode)
+    if isinstance(memory, array):
+      memory.fromstring(state['tape'])
+      if state['byteorder'] != sys.byteorder:
+        memory.byteswap()
     else:
-      self.code_pointer += 1
+      memory.extend(state['tape'])
+    self.memory = memory
+
+    self.pointer = state['pointer']
+    self.op_pointer = state['op_pointer']
+    self.code_pointer = self.op_positions[self.op_pointer]
+
+    if input is not None:
+      self.input = input
+    self.input_stream = InputStream(self.input, offset=state['input_offset'])
 
-  def i_jbnz(self):
-    if self.memory[self.pointer] != 0:
-      destination = self.bracket_map[self.code_pointer]
-      self.code_pointer = destination
+    if state['output'] is not None and isinstance(self.output, list):
+      self.output = state['output']
+    if state['op_log'] is not None:
+      self.op_log = state['op_log']
+      self._update_execution_log()
+
+  def _input_stream(self):
+    """ Returns the stream reading from `input`, which can be a
+    list, any iterator or a binary file, and can be replaced between
+    runs. `output` can likewise be a list or a `streams.OutputSink`.
+    """
+    if self.input_stream is None or self.input_stream.source is not self.input:
+      self.input_stream = InputStream(self.input)
+    return self.input_stream
+
+  def _update_execution_log(self):
+    """ Expands the per-op counters into per-symbol counts. Every
+    symbol of a fused run executes exactly as often as its op, so
+    the counts match those of a symbol-by-symbol run.
+    """
+    log = [0] * len(self.code)
+    positions = self.op_positions
+    for i, hits in enumerate(self.op_log):
+      if hits:
+        for position in xrange(positions[i], positions[i + 1]):
+          log[position] = hits
+    self.execution_log = log
+
+  def profile_report(self):
+    """ Returns a list of `(annotation, cost)` tuples, ranked by
+    the cost of each SM instruction, which is what the annotations
+    name.
+
+    With exact profiling the cost is in BF steps, taken from prefix
+    sums over the execution log. With sampling it is in decoded ops,
+    estimated as `samples * sample_interval`: a fused `+++++` or a
+    whole scan is one op, so ops can't be turned into BF steps.
+    """
+    totals = {}
+
+    if self.profile == PROFILE_ANNOTATIONS:
+      prefix = [0]
+      for hits in self.execution_log:
+        prefix.append(prefix[-1] + hits)
+      ends = [start for start, _ in self.annotations[1:]] + [len(self.code)]
+      for (start, annotation), end in zip(self.annotations, ends):
+        totals[annotation] = totals.get(annotation, 0) + prefix[end] - prefix[start]
+    elif self.profile == PROFILE_SAMPLED:
+      starts = [start for start, _ in self.annotations]
+      for i, hits in enumerate(self.samples):
+        if hits:
+          block = bisect.bisect_right(starts, self.op_positions[i]) - 1
+          annotation = self.annotations[block][1]
+          totals[annotation] = totals.get(annotation, 0) + hits * self.sample_interval
     else:
-      self.code_pointer += 1
+      raise Exception('profiling is off')
+
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    return [(annotation.rstrip(':'), cost) for annotation, cost in ranked]
+
+  def print_profile(self, limit=20):
+    report = self.profile_report()
+    unit = 'ops' if self.profile == PROFILE_SAMPLED else 'steps'
+    total = sum(cost for _, cost in report) or 1
+    print '%-24s %10s %7s' % ('annotation', unit, '')
+    for annotation, cost in report[:limit]:
+      print '%-24s %10d %6.2f%%' % (annotation, cost, cost * 100.0 / total)
 
-  def run(self):
+  def _overflow(self, message):
+    # the dump shows where and when the run stopped
+    self.code_pointer = self.op_positions[self.op_pointer]
+    self.end_time = time.time()
+    if self.profile == PROFILE_ANNOTATIONS:
+      self._update_execution_log()
+    print self
+    raise Exception(message)
+
+  def _execute(self, budget=-1, counting=False):
+    """ Executes at most `budget` ops, or until the program ends
+    if `budget` is negative. With `counting`, every executed op is
+    counted in `op_log`.
+    """
+    ops = self.ops
+    targets = self.jump_targets
+    op_log = self.op_log
+    memory = self.memory
+    read = self._input_stream().read
+    output = self.output
+    pointer = self.pointer
+    ip = self.op_pointer
+    ops_count = len(ops)
+    mask = (1 << self.cell_width) - 1 if self.mode == WRAPPING else 0
+
+    try:
+      while ip < ops_count and budget:
+        try:
+          while ip < ops_count and budget:
+            budget -= 1
+            if counting:
+              op_log[ip] += 1
+            op, count = ops[ip]
+
+            if op == OP_MOVE:
+              pointer += count
+            elif op == OP_ADD:
+              if mask:
+                memory[pointer] = (memory[pointer] + count) & mask
+              else:
+                memory[pointer] += count
+            elif op == OP_JFZ:
+              if memory[pointer] == 0:
+                # land on the matching `]`, which then falls through
+                ip = targets[ip]
+                if counting:
+                  op_log[ip] += 1
+            elif op == OP_JBNZ:
+              if memory[pointer] != 0:
+                # land on the matching `[`, which then falls through
+                ip = targets[ip]
+                if counting:
+                  op_log[ip] += 1
+            elif op == OP_SCAN:
+              steps = scan_zero(memory, pointer, count)
+              pointer += steps * count
+              if counting:
+                # account for the iterations a naive run would make: `[`
+                # and `]` are hit max(steps, 1) times, the move `steps` times
+                if steps:
+                  op_log[ip] += steps - 1
+                  op_log[ip + 1] += steps
+                  op_log[ip + 2] += steps
+                else:
+                  op_log[ip + 2] += 1
+              ip += 2
+            elif op == OP_PRINT:
+              output.extend([memory[pointer]] * count)
+            else:
+              if pointer >= len(memory):
+                grow_tape(memory, pointer + 1)
+              for _ in xrange(count):
+                memory[pointer] = read()
+
+            ip += 1
+        except IndexError:
+          if pointer < len(memory):
+            raise
+          # The pointer moved past the end of the tape. No op writes
+          # before it reads the current cell, so grow and retry it.
+          budget += 1
+          if counting:
+            op_log[ip] -= 1
+          grow_tape(memory, pointer + 1)
+        except NoInputLeft:
+          # nothing was read, so the op can be retried once there's input
+          if counting:
+            op_log[ip] -= 1
+          raise
+        except (ValueError, OverflowError):
+          # checked tapes reject out of range values themselves
+          self.pointer, self.op_pointer = pointer, ip
+          self._overflow('overflow' if ops[ip][1] > 0 else 'underflow')
+    finally:
+      self.pointer = pointer
+      self.op_pointer = ip
+      self.code_pointer = self.op_positions[ip]
+
+  def run(self, checkpoint_every=None, checkpoint_path=None):
+    """ Runs the program to the end. With `checkpoint_every`, a
+    snapshot is saved to `checkpoint_path` every that many ops.
+    """
     self.start_time = time.time()
-    while self.code_pointer < len(self.code):
-      self.execution_log[self.code_pointer] += 1
-      symbol = self.code[self.code_pointer]
-      self._decode_and_execute(symbol)
-    self.end_time = time.time()
\ No newline at end of file
+
+    counting = self.profile == PROFILE_ANNOTATIONS
+    sampled = self.profile == PROFILE_SAMPLED
+    if sampled:
+      budget = self.sample_interval
+    else:
+      budget = checkpoint_every or -1
+    since_checkpoint = 0
+
+    try:
+      while self.op_pointer < len(self.ops):
+        self._execute(budget, counting)
+        if sampled and self.op_pointer < len(self.ops):
+          self.samples[self.op_pointer] += 1
+
+        if checkpoint_every:
+          since_checkpoint += budget
+          if since_checkpoint >= checkpoint_every:
+            self.snapshot(checkpoint_path)
+            since_checkpoint = 0
+    finally:
+      self._finish_run()
+
+  def run_cooperative(self, slice_ops=1000):
+    """ Generator version of `run`, for hosting many programs in
+    one event loop. The program runs `slice_ops` ops at a time,
+    yielding None after every slice so the host can do other work.
+
+    When `,` finds no input, `WAITING_FOR_INPUT` is yielded instead
+    and the read is retried on the next resume. Use a
+    `collections.deque` as `input` to feed values while the program
+    is running:
+
+      machine.input = deque()
+      for state in machine.run_cooperative():
+        if state == WAITING_FOR_INPUT:
+          machine.input.append(next_value())
+    """
+    self.start_time = time.time()
+    counting = self.profile == PROFILE_ANNOTATIONS
+
+    try:
+      while self.op_pointer < len(self.ops):
+        try:
+          self._execute(slice_ops, counting)
+        except NoInputLeft:
+          yield WAITING_FOR_INPUT
+          continue
+        if self.op_pointer < len(self.ops):
+          yield None
+    finally:
+      self._finish_run()
+
+  def _finish_run(self):
+    if self.profile == PROFILE_ANNOTATIONS:
+      self._update_execution_log()
+    if hasattr(self.output, 'flush'):
+      self.output.flush()
+    self.end_time = time.time()
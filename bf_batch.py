@@ -0,0 +1,154 @@
+import time
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from bf import Brainfuck, CHECKED, WRAPPING, \
+  OP_MOVE, OP_ADD, OP_JFZ, OP_JBNZ, OP_PRINT, OP_SCAN
+from streams import NoInputLeft
+
+CELL_DTYPES = {8: 'uint8', 16: 'uint16', 32: 'uint32'}
+
+class BatchBrainfuck(object):
+  """ Runs one program over many inputs in lockstep. The tapes are
+  the rows of a 2-D NumPy array and every op is executed as one
+  vectorized operation over all instances that are still active.
+
+  Divergence at brackets is handled by masking: instances whose
+  cell is zero at `[` sit out the loop, and instances that leave
+  a loop early wait at its `]` until the rest catch up. Since the
+  waiting instances don't execute anything, the results are the
+  same as running every input through `Brainfuck` separately.
+
+  Only checked and wrapping tapes are supported.
+  """
+  def __init__(self, code, inputs, cell_width=8, mode=CHECKED, tape_size=50 * 3):
+    if np is None:
+      raise Exception('BatchBrainfuck requires numpy')
+    if mode not in (CHECKED, WRAPPING):
+      raise Exception('unsupported tape mode for a batch: ' + str(mode))
+    if cell_width not in CELL_DTYPES:
+      raise Exception('unsupported cell width: ' + str(cell_width))
+
+    # reuse the decoding of the interpreter
+    program = Brainfuck(code)
+    self.code = program.code
+    self.annotations = program.annotations
+    self.ops = program.ops
+    self.jump_targets = program.jump_targets
+
+    self.cell_width = cell_width
+    self.mode = mode
+    self.inputs = [list(values) for values in inputs]
+    self.outputs = [[] for _ in self.inputs]
+    self.size = len(self.inputs)
+
+    self.memory = np.zeros((self.size, tape_size), dtype=CELL_DTYPES[cell_width])
+    self.pointers = np.zeros(self.size, dtype=np.int64)
+    self.input_positions = [0] * self.size
+    self.executed_ops = 0
+    self.start_time = 0
+    self.end_time = 0
+
+  def __str__(self):
+    print 'instances:', self.size
+    print 't:', (self.end_time - self.start_time) * 1000, 'ms'
+    print 'executed ops:', self.executed_ops
+    for i, output in enumerate(self.outputs):
+      print i, 'output:', output
+
+    return ''
+
+  def _grow(self, rows):
+    """ Widens every tape so the pointers of `rows` are in range. """
+    if not len(rows):
+      return
+    needed = int(self.pointers[rows].max()) + 1
+    width = self.memory.shape[1]
+    if needed > width:
+      extra = np.zeros((self.size, max(needed, width * 2) - width), dtype=self.memory.dtype)
+      self.memory = np.concatenate((self.memory, extra), axis=1)
+
+  def _cells(self, rows):
+    return self.memory[rows, self.pointers[rows]]
+
+  def _add(self, rows, count):
+    values = self._cells(rows).astype(np.int64) + count
+    if self.mode == CHECKED:
+      if count > 0 and values.max() >> self.cell_width:
+        raise Exception('overflow')
+      if count < 0 and values.min() < 0:
+        raise Exception('underflow')
+    else:
+      values &= (1 << self.cell_width) - 1
+    self.memory[rows, self.pointers[rows]] = values
+
+  def run(self):
+    """ Runs every instance to the end. Like `Brainfuck`, raises
+    `NoInputLeft` when an instance reads past the end of its input. """
+    self.start_time = time.time()
+    if not self.size:
+      self.end_time = time.time()
+      return
+
+    ops = self.ops
+    targets = self.jump_targets
+    pointers = self.pointers
+    ops_count = len(ops)
+
+    rows = np.arange(self.size)
+    masks = [] # active rows outside of the loops we're in
+    ip = 0
+
+    while ip < ops_count:
+      self.executed_ops += 1
+      op, count = ops[ip]
+
+      if op == OP_MOVE:
+        pointers[rows] += count
+        if count > 0:
+          self._grow(rows)
+      elif op == OP_ADD:
+        self._add(rows, count)
+      elif op == OP_JFZ:
+        masks.append(rows)
+        rows = rows[self._cells(rows) != 0]
+        if not len(rows):
+          # nobody enters the loop
+          rows = masks.pop()
+          ip = targets[ip]
+      elif op == OP_JBNZ:
+        rows = rows[self._cells(rows) != 0]
+        if len(rows):
+          # go back, skipping the `[` test we just did
+          ip = targets[ip]
+        else:
+          rows = masks.pop()
+      elif op == OP_SCAN:
+        moving = rows[self._cells(rows) != 0]
+        while len(moving):
+          pointers[moving] += count
+          if count > 0:
+            self._grow(moving)
+          moving = moving[self._cells(moving) != 0]
+        ip += 2
+      elif op == OP_PRINT:
+        for row, value in zip(rows, self._cells(rows)):
+          self.outputs[row].extend([int(value)] * count)
+      else:
+        self._grow(rows)
+        for row in rows:
+          for _ in xrange(count):
+            if self.input_positions[row] >= len(self.inputs[row]):
+              raise NoInputLeft('no input left for instance ' + str(row))
+            value = self.inputs[row][self.input_positions[row]]
+            if self.mode == CHECKED and (value < 0 or value >> self.cell_width):
+              raise Exception('overflow')
+            self.memory[row, pointers[row]] = value
+            self.input_positions[row] += 1
+
+      ip += 1
+
+    self.end_time = time.time()
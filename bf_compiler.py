@@ -0,0 +1,287 @@
+import hashlib
+import marshal
+import os
+import stat
+import sys
+import time
+import types
+
+from snapshot import write_atomic
+from bf import Brainfuck, scan_zero, grow_tape, WRAPPING, \
+  OP_MOVE, OP_ADD, OP_JFZ, OP_PRINT, OP_READ, OP_SCAN
+
+# Bump when the generated code changes, so stale cache entries
+# are not picked up.
+COMPILER_VERSION = 3
+
+# CPython refuses more than 20 statically nested blocks in one
+# function; deeper loops are moved into functions of their own.
+MAX_LOOP_DEPTH = 16
+
+def default_cache_dir():
+  """ A cache directory of the current user's own, since the cached
+  code gets executed. """
+  cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(cache_home, 'bf_compiler')
+
+def prepare_cache_dir(cache_dir):
+  """ Creates `cache_dir` for the current user only, if missing.
+  Returns whether it is safe to load code from: a directory owned by
+  the current user that no one else can write to. """
+  if not os.path.isdir(cache_dir):
+    try:
+      os.makedirs(cache_dir, 0700)
+    except OSError:
+      if not os.path.isdir(cache_dir):
+        return False
+  return is_private(cache_dir)
+
+def is_private(path):
+  info = os.lstat(path)
+  if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+    return False
+  return not stat.S_ISLNK(info.st_mode) and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class PythonGen(object):
+  """ Translates the pre-decoded op stream of a `Brainfuck`
+  instance into the source of a Python module with a single
+  entry point:
+
+    program(m, p, read, output) -> p
+
+  Brackets become `while` loops, runs become `+= n` and pointer
+  moves inside straight-line code are folded into index offsets.
+  Loops that only move values around, like `[-]` or
+  `[-<<<+>>>]`, are replaced with direct assignments.
+
+  Range checks are left to the tape storage, see `bf.new_tape`;
+  a non-zero `mask` makes every addition wrap around instead.
+  Whenever the pointer moves right, the tape is grown so that
+  `HEADROOM` cells past the pointer exist, which covers every
+  offset used before the pointer moves again.
+  """
+  def __init__(self, ops, jump_targets, annotations, mask=0):
+    self.ops = ops
+    self.jump_targets = jump_targets
+    self.annotations = annotations # op index -> text
+    self.mask = mask
+    self.functions = []
+    self.headroom = 1
+
+  def _index(self, offset):
+    if offset == 0:
+      return 'm[p]'
+    return 'm[p %s %d]' % ('+' if offset > 0 else '-', abs(offset))
+
+  def _add(self, offset, value):
+    """ Returns the statement adding `value` to the cell at `offset`. """
+    self.headroom = max(self.headroom, offset + 1)
+    cell = self._index(offset)
+    if self.mask:
+      return '%s = (%s + %s) & %d' % (cell, cell, value, self.mask)
+    return '%s += %s' % (cell, value)
+
+  def _transfer_loop(self, start, end):
+    """ Returns {offset: delta} if the loop body between `start`
+    and `end` only adds to cells and returns to where it started,
+    decrementing the current cell by one per iteration. Such a loop
+    runs exactly `m[p]` times and can be replaced by additions.
+    """
+    deltas = {}
+    offset = 0
+    for op, count in self.ops[start:end]:
+      if op == OP_MOVE:
+        offset += count
+      elif op == OP_ADD:
+        deltas[offset] = deltas.get(offset, 0) + count
+      else:
+        return None
+    if offset != 0 or deltas.get(0) != -1:
+      return None
+    return deltas
+
+  def _flush(self, indent, lines, offset):
+    if offset < 0:
+      lines.append(indent + 'p -= %d' % -offset)
+    elif offset > 0:
+      lines.append(indent + 'p += %d' % offset)
+      self._grow(indent, lines)
+
+  def _grow(self, indent, lines):
+    lines.append(indent + 'if p + HEADROOM > len(m): grow_tape(m, p + HEADROOM)')
+
+  def block(self, start, end, depth):
+    """ Generates the lines for ops[start:end]. """
+    indent = '  ' * (depth + 1)
+    ops = self.ops
+    lines = []
+    offset = 0
+
+    i = start
+    while i < end:
+      op, count = ops[i]
+
+      if i in self.annotations:
+        lines.append(indent + '# ' + self.annotations[i])
+
+      if op == OP_MOVE:
+        offset += count
+      elif op == OP_ADD:
+        lines.append(indent + self._add(offset, count))
+      elif op == OP_PRINT:
+        self.headroom = max(self.headroom, offset + 1)
+        for _ in xrange(count):
+          lines.append(indent + 'output.append(%s)' % self._index(offset))
+      elif op == OP_READ:
+        self.headroom = max(self.headroom, offset + 1)
+        for _ in xrange(count):
+          lines.append(indent + '%s = read()' % self._index(offset))
+      elif op == OP_SCAN:
+        self._flush(indent, lines, offset)
+        offset = 0
+        lines.append(indent + 'p += scan_zero(m, p, %d) * %d' % (count, count))
+        if count > 0:
+          self._grow(indent, lines)
+        i += 2
+      elif op == OP_JFZ:
+        self._flush(indent, lines, offset)
+        offset = 0
+        close = self.jump_targets[i]
+        deltas = self._transfer_loop(i + 1, close)
+
+        if deltas is not None:
+          lines.append(indent + 'if m[p]:')
+          for target, delta in sorted(deltas.items()):
+            if target == 0:
+              continue
+            if delta == 1:
+              value = 'm[p]'
+            else:
+              value = 'm[p] * %d' % delta
+            lines.append(indent + '  ' + self._add(target, value))
+          lines.append(indent + '  m[p] = 0')
+        elif depth + 1 >= MAX_LOOP_DEPTH:
+          name = self.loop_function(i, close)
+          lines.append(indent + 'p = %s(m, p, read, output)' % name)
+        else:
+          lines.append(indent + 'while m[p]:')
+          lines.extend(self.block(i + 1, close, depth + 1) or [indent + '  pass'])
+
+        i = close
+      i += 1
+
+    self._flush(indent, lines, offset)
+    return lines
+
+  def loop_function(self, start, end):
+    """ Moves the loop ops[start:end + 1] into a function of its
+    own, resetting the nesting depth. """
+    name = 'loop_' + str(start)
+    lines = ['def %s(m, p, read, output):' % name, '  while m[p]:']
+    lines.extend(self.block(start + 1, end, 1) or ['    pass'])
+    lines.append('  return p')
+    self.functions.append('\n'.join(lines))
+    return name
+
+  def to_string(self):
+    main = ['def program(m, p, read, output):']
+    self._grow('  ', main)
+    main.extend(self.block(0, len(self.ops), 0))
+    main.append('  return p')
+
+    header = 'HEADROOM = %d' % self.headroom
+    return '\n\n'.join([header] + self.functions + ['\n'.join(main)]) + '\n'
+
+
+def generate_source(machine):
+  """ Returns the Python source for a loaded `Brainfuck` machine. """
+  # map annotations to the index of the op they start at
+  op_annotations = {}
+  annotations = iter(machine.annotations)
+  pending = next(annotations, None)
+  for i, position in enumerate(machine.op_positions[:-1]):
+    while pending is not None and pending[0] <= position:
+      if pending[1]:
+        op_annotations[i] = pending[1]
+      pending = next(annotations, None)
+
+  mask = (1 << machine.cell_width) - 1 if machine.mode == WRAPPING else 0
+  gen = PythonGen(machine.ops, machine.jump_targets, op_annotations, mask)
+  return gen.to_string()
+
+def load_program(machine, cache_dir=None):
+  """ Returns the compiled `program` function for a loaded
+  `Brainfuck` machine. Compiled code objects are cached on disk,
+  keyed by a hash of the code. A cache directory that others could
+  have written to is not used, see `prepare_cache_dir`.
+  """
+  if cache_dir is None:
+    cache_dir = default_cache_dir()
+  cached = prepare_cache_dir(cache_dir)
+
+  key = hashlib.sha1('%d:%s:%s:%d:%s' % (COMPILER_VERSION, sys.version,
+    machine.mode, machine.cell_width, machine.code)).hexdigest()
+  path = os.path.join(cache_dir, key + '.marshal')
+
+  code_obj = None
+  if cached and os.path.exists(path) and is_private(path):
+    try:
+      with open(path, 'rb') as f:
+        code_obj = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      code_obj = None # unreadable or corrupt entry, recompile
+    if not isinstance(code_obj, types.CodeType):
+      code_obj = None
+
+  if code_obj is None:
+    code_obj = compile(generate_source(machine), '<bf:' + key[:12] + '>', 'exec')
+    if cached:
+      write_atomic(path, marshal.dumps(code_obj))
+
+  namespace = {'scan_zero': scan_zero, 'grow_tape': grow_tape}
+  exec code_obj in namespace
+  return namespace['program']
+
+
+class CompiledBrainfuck(Brainfuck):
+  """ Drop-in replacement for `Brainfuck` that runs the code as
+  generated Python instead of through the interpreter loop.
+
+  The `memory`, `pointer`, `input` and `output` results are the
+  same as those of `Brainfuck.run`. The `execution_log` is not
+  kept, only the compile time is.
+
+  The decoded program is cached next to the compiled code. The
+  generated function can only run a program from its start, so
+  runs resumed from a snapshot or checkpointed along the way fall
+  back to the interpreter.
+  """
+  def __init__(self, code, cache_dir=None, **options):
+    if cache_dir is None:
+      cache_dir = default_cache_dir()
+    # the decoded program ends up in the generated code too
+    program_cache_dir = cache_dir if prepare_cache_dir(cache_dir) else None
+    Brainfuck.__init__(self, code, cache_dir=program_cache_dir, **options)
+
+    start = time.time()
+    self.program = load_program(self, cache_dir)
+    self.compile_time = time.time() - start
+
+  def run(self, checkpoint_every=None, checkpoint_path=None):
+    if self.op_pointer or checkpoint_every:
+      return Brainfuck.run(self, checkpoint_every, checkpoint_path)
+
+    self.start_time = time.time()
+    try:
+      read = self._input_stream().read
+      self.pointer = self.program(self.memory, self.pointer, read, self.output)
+      self.op_pointer = len(self.ops)
+      self.code_pointer = len(self.code)
+    except (ValueError, OverflowError):
+      # checked tapes reject out of range values themselves
+      raise Exception('overflow')
+    finally:
+      if hasattr(self.output, 'flush'):
+        self.output.flush()
+      self.end_time = time.time()
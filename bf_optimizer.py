@@ -0,0 +1,85 @@
+from bf import Brainfuck, PROFILE_ANNOTATIONS, split_annotated_line
+
+INVERSE = {'+': '-', '-': '+', '<': '>', '>': '<'}
+
+def peephole(code):
+  """ Removes code without effect from annotated BF code, as glued
+  together by `sm_to_brainfuck`:
+
+  - adjacent symbols that undo each other, like `+-` or `><`, also
+    when they only become adjacent once the code between them is
+    gone, e.g. `+<<<-+>>>-` from a `pop` followed by a `push`
+  - loops right after a `]`, which can never run, since the current
+    cell is zero when a loop exits; e.g. `[-]` on a cleared cell
+
+  Every annotation line is kept, even when all of its code is gone.
+
+  Returns the optimized code and the positions of the removed
+  symbols in the code without annotations.
+  """
+  lines = []
+  for line in code.strip().split('\n'):
+    if line and not line.isspace():
+      lines.append(split_annotated_line(line))
+
+  kept = [] # (line number, symbol)
+  positions = [] # positions of the kept symbols
+  removed = []
+  dead_depth = 0 # nesting depth inside a dead loop
+
+  position = 0
+  for l_num, (annotation, line_code) in enumerate(lines):
+    for symbol in line_code:
+      if dead_depth:
+        removed.append(position)
+        if symbol == '[':
+          dead_depth += 1
+        elif symbol == ']':
+          dead_depth -= 1
+      elif symbol == '[' and kept and kept[-1][1] == ']':
+        removed.append(position)
+        dead_depth = 1
+      elif symbol in INVERSE and kept and kept[-1][1] == INVERSE[symbol]:
+        kept.pop()
+        removed.append(positions.pop())
+        removed.append(position)
+      else:
+        kept.append((l_num, symbol))
+        positions.append(position)
+      position += 1
+
+  # put the remaining code back on the lines it came from
+  line_codes = [[] for _ in lines]
+  for l_num, symbol in kept:
+    line_codes[l_num].append(symbol)
+
+  optimized = []
+  for (annotation, _), line_code in zip(lines, line_codes):
+    optimized.append((annotation + ' ' + ''.join(line_code)).strip() + '\n')
+
+  return ''.join(optimized), sorted(removed)
+
+def peephole_report(code, input=()):
+  """ Runs the unoptimized code once with profiling, and reports
+  the code size and executed steps before and after `peephole`.
+
+  Removed symbols only ever come from straight-line code or from
+  loops that are skipped, so the steps saved are exactly the
+  execution counts of the removed symbols.
+  """
+  optimized, removed = peephole(code)
+
+  machine = Brainfuck(code, profile=PROFILE_ANNOTATIONS)
+  machine.input = list(input)
+  machine.run()
+
+  steps = sum(machine.execution_log)
+  steps_saved = sum(machine.execution_log[position] for position in removed)
+
+  return {
+    'optimized': optimized,
+    'code_size_before': len(machine.code),
+    'code_size_after': len(machine.code) - len(removed),
+    'steps_before': steps,
+    'steps_after': steps - steps_saved
+  }
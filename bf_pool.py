@@ -0,0 +1,50 @@
+import multiprocessing
+import time
+
+from bf import Brainfuck, PROFILE_ANNOTATIONS
+from brain_machine import sm_to_brainfuck
+
+# The machine of the current worker process, see `_init_worker`.
+_machine = None
+
+def _init_worker(engine, code, options):
+  """ Parses the program once per worker; jobs only reset it. """
+  global _machine
+  _machine = engine(code, **options)
+
+def _run_job(values):
+  _machine.reset()
+  _machine.input = list(values)
+
+  start = time.time()
+  _machine.run()
+  seconds = time.time() - start
+
+  return _machine.output, sum(_machine.execution_log), seconds
+
+def run_batch(code, inputs, processes=None, engine=Brainfuck, chunksize=1, **options):
+  """ Runs a BF program once for every input list in `inputs` on a
+  pool of worker processes, and yields an `(output, steps, seconds)`
+  tuple per input, in input order, as soon as it is available.
+
+  `engine` is the machine class used by the workers, e.g.
+  `bf_compiler.CompiledBrainfuck`, and `options` are passed to its
+  constructor. Steps are counted with `PROFILE_ANNOTATIONS` unless
+  another profile is given; engines or profiles that don't keep an
+  execution log report zero steps.
+  """
+  options.setdefault('profile', PROFILE_ANNOTATIONS)
+  pool = multiprocessing.Pool(processes, _init_worker, (engine, code, options))
+  try:
+    for result in pool.imap(_run_job, inputs, chunksize):
+      yield result
+  finally:
+    pool.terminate()
+    pool.join()
+
+def run_sm_batch(sm_code, usr_mem_size, stack_size, inputs, **kwargs):
+  """ Same as `run_batch`, but starts from SM instructions. The BF
+  code is generated once, in the calling process.
+  """
+  code = sm_to_brainfuck(sm_code, usr_mem_size, stack_size)
+  return run_batch(code, inputs, **kwargs)
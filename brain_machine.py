@@ -1,9 +1,165 @@
+from collections import OrderedDict
+
+from bf_optimizer import peephole
+
 WLK = 'walk_lane'
 SP = 'stack_pointer_lane'
 MEM = 'memory_lane'
 
+# REG_A to REG_D
+REGISTERS = 4
+
+# REG_B, the address register of `loadrb` and `storerb`
+REG_B = 1
+
+# Cells above the stack top that instructions use as temporaries;
+# `gte` goes up to 5 cells past its second operand.
+SCRATCH_CELLS = 5
+
+
+# Memory layouts
+
+class LaneLayout(object):
+  """ Places the tape in cells of one value per lane, `lanes` giving
+  their order within a cell:
+
+  - the walk lane is 0 at REG_A and 1 elsewhere, so `[<<<]` finds REG_A
+  - the stack pointer lane is 0 at the stack top and 1 elsewhere
+  - the memory lane holds the registers, variables and the stack
+
+  The cells are REG_A to REG_D, then the user variables, then the
+  stack. Every SM instruction is generated in terms of the layout, so
+  the same SM code can be benchmarked on different layouts.
+  """
+  # whether `loadrb` and `storerb` work with this layout
+  dynamic_access = True
+  stack_after_memory = True
+
+  def __init__(self, lanes=(WLK, SP, MEM)):
+    self.lanes = tuple(lanes)
+    self.width = len(self.lanes)
+
+  def key(self):
+    return (self.__class__.__name__, self.lanes)
+
+  def __eq__(self, other):
+    return isinstance(other, LaneLayout) and self.key() == other.key()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.key())
+
+  def offset(self, lane):
+    return self.lanes.index(lane)
+
+  def cell(self, addr):
+    """ The index of the cell holding memory address `addr`. """
+    return addr
+
+  def regions(self, usr_mem_size, stack_size):
+    return [('registers', REGISTERS), ('memory', usr_mem_size), ('stack', stack_size)]
+
+  def tape(self, usr_mem_size, stack_size):
+    """ The initial values of the tape. """
+    tape = []
+    for region, size in self.regions(usr_mem_size, stack_size):
+      for i in xrange(size):
+        values = {
+          WLK: 0 if region == 'registers' and i == 0 else 1,
+          SP: 0 if region == 'stack' and i == 0 else 1,
+          MEM: 0
+        }
+        tape.extend(values[lane] for lane in self.lanes)
+    return tape
+
+class StackFirstLayout(LaneLayout):
+  """ Places the stack between the registers and the user variables,
+  so that the walks between REG_A and the stack top don't cross all
+  of the variables; instead, variables are `stack_size` plus
+  `SCRATCH_CELLS` cells further away. Overflowing the stack overwrites
+  the first variables.
+
+  `loadrb` and `storerb` move a marker over the stack pointer lane,
+  where it would run into the stack pointer, so they are not supported.
+  """
+  dynamic_access = False
+  stack_after_memory = False
+
+  def __init__(self, stack_size, lanes=(WLK, SP, MEM)):
+    LaneLayout.__init__(self, lanes)
+    self.stack_size = stack_size
+
+  def key(self):
+    return LaneLayout.key(self) + (self.stack_size,)
+
+  def cell(self, addr):
+    if addr < REGISTERS:
+      return addr
+    return addr + self.stack_size + SCRATCH_CELLS
+
+  def regions(self, usr_mem_size, stack_size):
+    if stack_size != self.stack_size:
+      raise Exception('layout is for a stack size of ' + str(self.stack_size))
+    return [('registers', REGISTERS), ('stack', stack_size + SCRATCH_CELLS), ('memory', usr_mem_size)]
+
+DEFAULT_LAYOUT = LaneLayout()
+
+# Layouts by name, made for a given stack size.
+LAYOUTS = {
+  'default': lambda stack_size: DEFAULT_LAYOUT,
+  'walk_mem_sp': lambda stack_size: LaneLayout((WLK, MEM, SP)),
+  'stack_first': StackFirstLayout
+}
+
+
+# Constants
+
+def constant_cost(n, plan, width):
+  """ The code size and executed steps of setting a zero cell to `n`
+  with `plan`, see `cheapest_constant`. """
+  a, b, c = plan
+  if not a:
+    return abs(c), abs(c)
+
+  # >[-]+++[-<++++>]<++
+  size = width + 3 + a + 2 * width + b + 3 + width + abs(c)
+  steps = width + 1 + a + 1 + a * (2 * width + b + 2) + width + abs(c)
+  return size, steps
+
+def cheapest_constant(n, width):
+  """ Finds the cheapest way of setting a zero cell to `n`, by code
+  size plus executed steps, as an `(a, b, c)` plan for
+  `n = a * b + c`: the next cell is set to `a`, then a loop adds `b`
+  to the cell `a` times, and `c` is added at the end. A plan of
+  `(0, 0, n)` means plain `+` symbols. """
+  best = (0, 0, n)
+  best_cost = sum(constant_cost(n, best, width))
+  for a in xrange(2, n + 1):
+    b, c = divmod(n, a)
+    # also try overshooting and counting down, without overflowing
+    for b, c in ((b, c), (b + 1, c - a)):
+      if b < 2 or a * b > max(n, 255):
+        continue
+      cost = sum(constant_cost(n, (a, b, c), width))
+      if cost < best_cost:
+        best, best_cost = (a, b, c), cost
+  return best
+
+# Plans for 0-255 by cell width, see `constant_table`.
+CONSTANT_TABLES = {}
+
+def constant_table(width):
+  """ The cheapest plans for 0-255 on a layout `width` lanes wide. """
+  if width not in CONSTANT_TABLES:
+    CONSTANT_TABLES[width] = [cheapest_constant(n, width) for n in xrange(256)]
+  return CONSTANT_TABLES[width]
+
+
 class CodeGen(object):
-  def __init__(self):
+  def __init__(self, layout=DEFAULT_LAYOUT):
+    self.layout = layout
     self.code = []
 
   def comment(self, msg):
@@ -18,6 +174,32 @@ class CodeGen(object):
   def set(self, n):
     self.append('+' * n)
 
+  def constant(self, n):
+    """ Sets the current cell, which must be zero, to `n`, using the
+    memory lane of the next cell as scratch. """
+    if n < 256:
+      a, b, c = constant_table(self.layout.width)[n]
+    else:
+      a, b, c = cheapest_constant(n, self.layout.width)
+
+    if a:
+      # scratch = a; scratch[-; cell += b; scratch]
+      self.big_right()
+      self.decrement_to_zero()
+      self.set(a)
+      self.start_loop()
+      self.decrement()
+      self.big_left()
+      self.set(b)
+      self.big_right()
+      self.end_loop()
+      self.big_left()
+
+    if c < 0:
+      self.append('-' * -c)
+    else:
+      self.set(c)
+
   def set_and_next(self, n):
     self.set(n)
     self.next()
@@ -26,43 +208,49 @@ class CodeGen(object):
     self.append('>')
 
   def big_right(self, n=1):
-    self.append('>>>' * n)
+    self.append('>' * self.layout.width * n)
 
   def big_left(self, n=1):
-    self.append('<<<' * n)
+    self.append('<' * self.layout.width * n)
 
   def widen_stack(self):
-    self.append('+>>>-')
+    self.increment()
+    self.big_right()
+    self.decrement()
 
   def shrink_stack(self):
-    self.append('+<<<-')
+    self.increment()
+    self.big_left()
+    self.decrement()
 
   def switch_lane(self, current, target):
-    lane_jumps = {
-      WLK: {
-        SP: '>',
-        MEM: '>>'
-      },
-      SP: {
-        WLK: '<',
-        MEM: '>'
-      },
-      MEM: {
-        WLK: '<<',
-        SP: '<'
-      }
-    }
-
-    return self.append(lane_jumps[current][target])
+    jump = self.layout.offset(target) - self.layout.offset(current)
+    if jump > 0:
+      self.append('>' * jump)
+    else:
+      self.append('<' * -jump)
+
+  def variable_to_stack(self):
+    """ Goes from a variable in the memory lane to the stack top in
+    the stack pointer lane. """
+    self.switch_lane(MEM, SP)
+    if self.layout.stack_after_memory:
+      self.search_zero_right()
+    else:
+      self.search_zero_left()
 
   def decrement_to_zero(self):
     self.append('[-]')
 
   def search_zero_left(self):
-    self.append('[<<<]')
+    self.start_loop()
+    self.big_left()
+    self.end_loop()
 
   def search_zero_right(self):
-    self.append('[>>>]')
+    self.start_loop()
+    self.big_right()
+    self.end_loop()
 
   def print_val(self):
     self.append('.')
@@ -92,17 +280,22 @@ class CodeGen(object):
 SM instruction cost in BF instructions:
 
 init: mem_size + stack_size
-push: (prev_num * 2) + n
+push: (prev_num * 2) + n, less for big n, see `cheapest_constant`
 pop: 5
 add: a + b
 subtract: a + b
 bnot: n + const
 band: (a + b) * factor (total is between 137 (a,b=1) 62.5 (a,b=10) and 55.2 (a,b=255))
+
+See sm_cost.py for estimates of whole programs.
 '''
 
 class CodeGenHigh(object):
+  def __init__(self, layout=None):
+    self.layout = layout or DEFAULT_LAYOUT
+
   def init(self, usr_mem_size=0, stack_size=4):
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('init_m_' + str(usr_mem_size) + '_s_' + str(stack_size))
 
@@ -111,17 +304,14 @@ class CodeGenHigh(object):
     # User defined variables +
     # SP +
     # Stack memory
-    mem = [0, 1, 0] + \
-          [1, 1, 0] * 3 + \
-          [1, 1, 0] * usr_mem_size + \
-          [1, 0, 0] + \
-          [1, 1, 0] * (stack_size - 1)
+    # (in the order of the layout)
+    mem = self.layout.tape(usr_mem_size, stack_size)
 
     for val in mem:
       code.set_and_next(val)
 
     # go to SP
-    code.append('<<')
+    code.append('<' * (self.layout.width - self.layout.offset(SP)))
     code.search_zero_left()
 
     code.newline()
@@ -133,13 +323,13 @@ class CodeGenHigh(object):
     
     Stack count: +1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('push_' + str(n))
     code.widen_stack()
     code.switch_lane(SP, MEM)
     code.decrement_to_zero()
-    code.set(n)
+    code.constant(n)
     code.switch_lane(MEM, SP)
     code.newline()
 
@@ -153,7 +343,7 @@ class CodeGenHigh(object):
     
     Stack count: -1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('pop')
     code.shrink_stack()
@@ -167,13 +357,19 @@ class CodeGenHigh(object):
     
     Stack count: -1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('add')
     code.shrink_stack()
     code.switch_lane(SP, MEM)
     code.big_right() # go to y
-    code.append('[-<<<+>>>]') # (while (y != 0) {dec y; inc x})
+    # (while (y != 0) {dec y; inc x})
+    code.start_loop()
+    code.decrement()
+    code.big_left()
+    code.increment()
+    code.big_right()
+    code.end_loop()
     code.big_left() # go to x
     code.switch_lane(MEM, SP)
     code.newline()
@@ -187,13 +383,19 @@ class CodeGenHigh(object):
     
     Stack count: -1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('subtract')
     code.shrink_stack()
     code.switch_lane(SP, MEM)
     code.big_right() # go to y
-    code.append('[-<<<->>>]') # (while (y != 0) {dec y; dec x})
+    # (while (y != 0) {dec y; dec x})
+    code.start_loop()
+    code.decrement()
+    code.big_left()
+    code.decrement()
+    code.big_right()
+    code.end_loop()
     code.big_left() # go to x
     code.switch_lane(MEM, SP)
     code.newline()
@@ -207,7 +409,7 @@ class CodeGenHigh(object):
 
     Stack count: 0
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('bnot')
 
@@ -250,7 +452,7 @@ class CodeGenHigh(object):
     Stack count: -1
     """
 
-    code = CodeGen()
+    code = CodeGen(self.layout)
     code.comment('band')
 
     # Go to X
@@ -333,6 +535,88 @@ class CodeGenHigh(object):
     ]
     '''
 
+  def bandb(self, _):
+    """ Boolean AND of the two topmost values on the
+    stack, which must both be 0 or 1. Unlike `band`, it
+    runs in constant time. Destroys the values.
+
+    Note: `y` is the topmost value.
+
+    Stack count: -1
+    """
+    code = CodeGen(self.layout)
+
+    code.comment('bandb')
+
+    # Go to X
+    code.shrink_stack()
+    code.switch_lane(SP, MEM)
+
+    # x += y: y[x+y-]
+    code.big_right()
+    code.start_loop()
+    code.decrement()
+    code.big_left()
+    code.increment()
+    code.big_right()
+    code.end_loop()
+
+    # x is 2 if both were 1; decrement it if it isn't 0,
+    # leaving the loop at y, which is 0: x[x-y]
+    code.big_left()
+    code.start_loop()
+    code.decrement()
+    code.big_right()
+    code.end_loop()
+
+    # We're at X or Y; find SP, which is at X
+    code.switch_lane(MEM, SP)
+    code.search_zero_left()
+    code.newline()
+
+    return code.to_string()
+
+  def borb(self, _):
+    """ Boolean OR of the two topmost values on the
+    stack, which must both be 0 or 1. Runs in constant
+    time. Destroys the values.
+
+    Note: `y` is the topmost value.
+
+    Stack count: -1
+    """
+    code = CodeGen(self.layout)
+
+    code.comment('borb')
+
+    # Go to X
+    code.shrink_stack()
+    code.switch_lane(SP, MEM)
+
+    # y += x: x[y+x-]
+    code.start_loop()
+    code.decrement()
+    code.big_right()
+    code.increment()
+    code.big_left()
+    code.end_loop()
+
+    # x = 1 if y isn't 0: y[y[-]x+y]
+    code.big_right()
+    code.start_loop()
+    code.decrement_to_zero()
+    code.big_left()
+    code.increment()
+    code.big_right()
+    code.end_loop()
+
+    # Go to X
+    code.big_left()
+    code.switch_lane(MEM, SP)
+    code.newline()
+
+    return code.to_string()
+
 
 
   def gte(self, _):
@@ -345,7 +629,7 @@ class CodeGenHigh(object):
     
     Stack count: -1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('gte')
 
@@ -445,7 +729,7 @@ class CodeGenHigh(object):
     
     Stack count: 0
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('prnt')
     code.switch_lane(SP, MEM)
@@ -460,7 +744,7 @@ class CodeGenHigh(object):
     
     Stack count: +1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('read')
     code.widen_stack()
@@ -477,7 +761,7 @@ class CodeGenHigh(object):
     
     Stack count: +1
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('load_addr_' + str(addr))
 
@@ -493,8 +777,7 @@ class CodeGenHigh(object):
     code.decrement_to_zero()
 
     # go to mem[addr]
-    for _ in xrange(addr):
-      code.big_right()
+    code.big_right(self.layout.cell(addr))
 
     # LOOP: copy the variable to stack, using REG_A as tmp
     code.start_loop()
@@ -514,8 +797,7 @@ class CodeGenHigh(object):
     code.increment()
 
     #   3. go to mem[n] and decrement
-    for _ in xrange(addr):
-      code.big_right()
+    code.big_right(self.layout.cell(addr))
     code.decrement()
 
     # LOOP: end
@@ -530,8 +812,7 @@ class CodeGenHigh(object):
     code.start_loop()
 
     #   1. go to mem[n] and increment
-    for _ in xrange(addr):
-      code.big_right()
+    code.big_right(self.layout.cell(addr))
     code.increment()
 
     #   3. go to REG_A and decrement
@@ -553,14 +834,17 @@ class CodeGenHigh(object):
 
   def loadrb(self, _):
     """ Dynamic memory load: reads an address from
-    REG_B, then fetches the value found at mem[addr] and
-    pushes it on the stack.
+    REG_B, then fetches the value found at mem[addr] into
+    REG_B, from where `load 1` can push it on the stack.
 
     Note: mem[0] is not accessible via `loadrb`.
     
-    Stack count: +1
+    Stack count: 0
     """
-    code = CodeGen()
+    if not self.layout.dynamic_access:
+      raise Exception('loadrb is not supported by this memory layout')
+
+    code = CodeGen(self.layout)
 
     code.comment('loadrb')
 
@@ -672,7 +956,7 @@ class CodeGenHigh(object):
     
     Stack count: 0
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('store_addr_' + str(addr))
 
@@ -683,13 +967,11 @@ class CodeGenHigh(object):
     code.decrement_to_zero()
 
     # go to mem[addr] and set to zero
-    for _ in xrange(addr):
-      code.big_right()
+    code.big_right(self.layout.cell(addr))
     code.decrement_to_zero()
 
     # goto mem@sp
-    code.switch_lane(MEM, SP)
-    code.search_zero_right()
+    code.variable_to_stack()
     code.switch_lane(SP, MEM)
 
 
@@ -703,13 +985,11 @@ class CodeGenHigh(object):
     code.increment()
 
     #   2. go to mem[addr] and increment
-    for _ in xrange(addr):
-      code.big_right()
+    code.big_right(self.layout.cell(addr))
     code.increment()
 
     #   3. go to mem@sp and decrement
-    code.switch_lane(MEM, SP)
-    code.search_zero_right()
+    code.variable_to_stack()
     code.switch_lane(SP, MEM)
     code.decrement()
 
@@ -759,7 +1039,10 @@ class CodeGenHigh(object):
     
     Stack count: 0
     """
-    code = CodeGen()
+    if not self.layout.dynamic_access:
+      raise Exception('storerb is not supported by this memory layout')
+
+    code = CodeGen(self.layout)
 
     code.comment('storerb')
 
@@ -882,7 +1165,7 @@ class CodeGenHigh(object):
     
     Stack count: 0
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('jfz')
     code.switch_lane(SP, MEM)
@@ -899,7 +1182,7 @@ class CodeGenHigh(object):
 
     Stack count: 0
     """
-    code = CodeGen()
+    code = CodeGen(self.layout)
 
     code.comment('jbnz')
     code.switch_lane(SP, MEM)
@@ -910,39 +1193,175 @@ class CodeGenHigh(object):
     return code.to_string()
 
 
+# The "Stack count" of every instruction of `CodeGenHigh`.
+STACK_EFFECTS = {
+  'push': 1, 'pop': -1, 'add': -1, 'subtract': -1, 'bnot': 0, 'band': -1, 'gte': -1,
+  'bandb': -1, 'borb': -1,
+  'prnt': 0, 'read': 1, 'load': 1, 'loadrb': 0, 'store': 0, 'storerb': 0,
+  'jfz': 0, 'jbnz': 0
+}
+
+# Instructions that briefly grow the stack further, e.g. `bnot` widens
+# it for a temporary value.
+TRANSIENT_STACK = {'bnot': 1}
+
+# Instructions whose result is always 0 or 1
+BOOLEAN = ('gte', 'band', 'bnot', 'bandb', 'borb')
+
+# The largest value of a cell. BF cells wrap around past it, the
+# stack machine doesn't.
+MAX_VALUE = 255
+
+
+# Static analysis
+
+def max_stack_depth(sm_code):
+  """ The deepest the stack gets when running `sm_code`, including
+  temporaries. Loops (`jfz` ... `jbnz`) must leave the stack as deep
+  as they found it, so a single pass suffices. """
+  depth = 0
+  max_depth = 0
+  loops = [] # depths at the open `jfz`s
+
+  for i, (cmd, _) in enumerate(sm_code):
+    if cmd == 'jfz':
+      loops.append(depth)
+    elif cmd == 'jbnz':
+      if not loops:
+        raise Exception('jbnz without jfz at instruction ' + str(i))
+      if loops.pop() != depth:
+        raise Exception('loop changes the stack depth at instruction ' + str(i))
+
+    max_depth = max(max_depth, depth + TRANSIENT_STACK.get(cmd, 0))
+    depth += STACK_EFFECTS[cmd]
+    if depth < 0:
+      raise Exception('stack underflow at instruction ' + str(i))
+    max_depth = max(max_depth, depth)
+
+  if loops:
+    raise Exception('jfz without jbnz')
+
+  return max_depth
+
+def required_sizes(sm_code):
+  """ The smallest `usr_mem_size` and `stack_size` that `sm_code` runs
+  with. The memory size comes from the highest `load`/`store` address;
+  programs using `loadrb`/`storerb` can reach further, so this raises
+  for them. The stack needs one cell more than its deepest depth,
+  since the stack pointer starts on a cell of its own. """
+  max_addr = REGISTERS - 1
+  for cmd, val in sm_code:
+    if cmd in ('loadrb', 'storerb'):
+      raise Exception('usr_mem_size can\'t be derived with ' + cmd)
+    if cmd in ('load', 'store'):
+      max_addr = max(max_addr, val)
+
+  return max_addr - REGISTERS + 1, max_stack_depth(sm_code) + 1
+
+
+# Emission cache
+
+class LRUCache(object):
+  """ A dict that keeps at most `size` items, dropping the least
+  recently used one when full. """
+  def __init__(self, size):
+    self.size = size
+    self.items = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    if key not in self.items:
+      self.misses += 1
+      return None
+    self.hits += 1
+    value = self.items.pop(key)
+    self.items[key] = value # move to the most recent end
+    return value
+
+  def put(self, key, value):
+    if key in self.items:
+      del self.items[key]
+    elif len(self.items) >= self.size:
+      self.items.popitem(last=False)
+    self.items[key] = value
+
+  def clear(self):
+    self.items.clear()
+    self.hits = 0
+    self.misses = 0
+
+EMIT_CACHE = LRUCache(4096)
+
+def emit(high_code_gen, cmd, val):
+  """ Returns the BF code for one SM instruction. A program uses the
+  same few `(cmd, val)` pairs over and over, so the code of each is
+  generated once and then served from `EMIT_CACHE`. """
+  key = (high_code_gen.__class__, high_code_gen.layout, cmd, val)
+  code = EMIT_CACHE.get(key)
+  if code is None:
+    code = getattr(high_code_gen, cmd)(val)
+    EMIT_CACHE.put(key, code)
+  return code
+
+
 # EXPORTS
 
-def sm_to_brainfuck(sm_code, usr_mem_size, stack_size):
-  """ Translates SM instructions to Brainfuck."""
-  bf_code = []
-  high_code_gen = CodeGenHigh()
-  
+def iter_brainfuck(sm_code, usr_mem_size=None, stack_size=None, layout=None):
+  """ Generator version of `sm_to_brainfuck`: takes any iterable of
+  SM instructions and yields the BF code one annotated line at a
+  time, e.g. to write it straight to a file:
+
+    for chunk in iter_brainfuck(iter_asm(open('prog.asm')), 10, 20):
+      out.write(chunk)
+
+  `layout` is the memory layout to generate for, see `LaneLayout`.
+
+  Sizes that aren't given are derived from the code, which then has to
+  be read in full before anything is yielded, see `required_sizes`.
+  """
+  high_code_gen = CodeGenHigh(layout)
+
+  if usr_mem_size is None or stack_size is None:
+    sm_code = list(sm_code)
+    if usr_mem_size is None:
+      usr_mem_size = required_sizes(sm_code)[0]
+    if stack_size is None:
+      stack_size = max_stack_depth(sm_code) + 1
+
   # init
-  init = high_code_gen.init(usr_mem_size, stack_size)
-  bf_code.append(init)
+  yield high_code_gen.init(usr_mem_size, stack_size)
 
   # convert each instruction:
-  #   ('push', 4) -> code.append("+++-<><>-...")
+  #   ('push', 4) -> "push_4: +>>>->[-]++++<\n"
   for instr in sm_code:
     cmd, val = instr
-    method = getattr(high_code_gen, cmd)
-    bf_code.append(method(val))
+    yield emit(high_code_gen, cmd, val)
 
-  return ''.join(bf_code)
+def sm_to_brainfuck(sm_code, usr_mem_size=None, stack_size=None, optimize=False, layout=None):
+  """ Translates SM instructions to Brainfuck. Sizes that aren't given
+  are derived from the code. With `optimize`, the result goes through
+  `bf_optimizer.peephole`."""
+  bf_code = ''.join(iter_brainfuck(sm_code, usr_mem_size, stack_size, layout))
+  if optimize:
+    bf_code, _ = peephole(bf_code)
 
-def parse_asm(code_string):
-  sm_code = []
+  return bf_code
 
-  # strip and remove empty lines
-  lines = [x.strip() for x in code_string.split('\n') if x != '']
+def iter_asm(lines):
+  """ Generator version of `parse_asm`, parsing SM assembly line by
+  line from any iterable of lines, like an open file. """
+  for line in lines:
+    line = line.strip()
 
-  # remove comments
-  no_comments = [x for x in lines if not x.startswith('#')]
+    # skip empty lines and comments
+    if not line or line.startswith('#'):
+      continue
 
-  for line in no_comments:
     split = line.split()
     cmd = split[0]
     val = int(split[1]) if len(split) > 1 else None
-    sm_code.append((cmd, val))
+    yield (cmd, val)
 
-  return sm_code
+def parse_asm(code_string):
+  return list(iter_asm(code_string.split('\n')))
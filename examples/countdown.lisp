@@ -0,0 +1,8 @@
+; Prints 10 down to 1, then whether the counter ended at 0.
+(let ((i 10))
+  (while (> i 0)
+    (print i)
+    (set i (- i 1)))
+  (if (== i 0)
+    (print 1)
+    (print 0)))
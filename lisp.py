@@ -1,22 +1,50 @@
+def iter_tokens(string):
+  """ Yields the tokens of `string`, walking it once by index. A `;`
+  starts a comment up to the end of the line. """
+  i = 0
+  n = len(string)
+  while i < n:
+    ch = string[i]
+    if ch in '()':
+      yield ch
+      i += 1
+    elif ch.isspace():
+      i += 1
+    elif ch == ';':
+      end = string.find('\n', i)
+      i = n if end == -1 else end
+    else:
+      start = i
+      while i < n and string[i] not in '();' and not string[i].isspace():
+        i += 1
+      yield string[start:i]
+
 def tokenize(string):
-  more_spaces = string.replace('(', ' ( ').replace(')', ' ) ')
-  return [token.strip() for token in more_spaces.split()]
+  return list(iter_tokens(string))
+
+def read_all(tokens):
+    "Read the expressions of a sequence of tokens, one at a time."
+    stack = [[]] # the lists being read, innermost last
+    for token in tokens:
+        if '(' == token:
+            stack.append([])
+        elif ')' == token:
+            if len(stack) == 1:
+                raise SyntaxError('unexpected )')
+            L = stack.pop()
+            stack[-1].append(L)
+        else:
+            stack[-1].append(atom(token))
+        if len(stack) == 1 and stack[0]:
+            yield stack[0].pop()
+    if len(stack) > 1:
+        raise SyntaxError('unexpected EOF while reading')
 
 def read_from_tokens(tokens):
     "Read an expression from a sequence of tokens."
-    if len(tokens) == 0:
-        raise SyntaxError('unexpected EOF while reading')
-    token = tokens.pop(0)
-    if '(' == token:
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from_tokens(tokens))
-        tokens.pop(0) # pop off ')'
-        return L
-    elif ')' == token:
-        raise SyntaxError('unexpected )')
-    else:
-        return atom(token)
+    for expr in read_all(tokens):
+        return expr
+    raise SyntaxError('unexpected EOF while reading')
 
 def atom(token):
   try:
@@ -168,21 +196,34 @@ def lte(expr_a, expr_b):
   return gte(expr_b, expr_a) # switched places
 
 def if_expr(cond_expr, then_expr, else_expr=None):
+  '''
+  cond_expr is evaluated only once. With an else_expr, a flag kept on
+  the stack below the then branch tells whether the else branch runs:
+
+    push 1, cond, jfz, pop, then, pop, push 0, push 0, jbnz, pop,
+    jfz, pop, else, push 0, jbnz, pop
+  '''
   res = []
+  if else_expr:
+    res.append(('push', 1)) # else flag
+
   res.extend(cond_expr)
 
   res.append(('jfz', None))
   res.append(('pop', None))
   res.extend(then_expr)
 
+  if else_expr:
+    # clear the else flag
+    res.append(('pop', None))
+    res.append(('push', 0))
+
   # make sure we don't jump backwards
   res.append(('push', 0))
   res.append(('jbnz', None))
   res.append(('pop', None))
 
   if else_expr:
-    res.extend(cond_expr)
-    res.append(('bnot', None))
     res.append(('jfz', None))
     res.append(('pop', None))
     res.extend(else_expr)
@@ -192,6 +233,21 @@ def if_expr(cond_expr, then_expr, else_expr=None):
 
   return res
 
+def cond(*arms):
+  '''
+  (cond (c1 e1) (c2 e2) ... else_expr) => if(c1, e1, if(c2, e2, ... else_expr))
+
+  Every arm is a (cond_expr, expr) pair; the last argument can be a
+  plain else_expr. Only the expr of the first true cond_expr runs, and
+  the cond_exprs after it are not evaluated.
+  '''
+  if not arms:
+    return []
+  if not isinstance(arms[0], tuple):
+    return arms[0]
+  (cond_expr, expr), rest = arms[0], arms[1:]
+  return if_expr(cond_expr, expr, cond(*rest))
+
 def while_expr(cond_expr, block_expr):
   res = []
   res.extend(cond_expr)
@@ -211,6 +267,143 @@ def blck(*exprs):
 
 
 
+# Compiling S-expressions
+#
+#   (let ((a 2)
+#         (b 3))
+#     (while (< a 5)
+#       (print (+ a b))
+#       (set a (+ a 1))))
+#
+# Expressions are numbers, variables, (read), (load addr) and
+# (op x y) for the ops in OPERATORS; (not x) negates. Statements are
+# (print x), (store addr x), (set var x), (let ((var x) ...) ...),
+# (if c then [else]), (cond (c ...) ... [(else ...)]), (while c ...)
+# and (begin ...); any other expression is evaluated and dropped.
+# `load` and `store` with a number address access it directly, and
+# through REG_B otherwise.
+
+from brain_machine import REGISTERS
+
+OPERATORS = {
+  '+': add,
+  '-': subtract,
+  '==': eq,
+  '!=': neq,
+  '>=': gte,
+  '<=': lte,
+  '<': lt,
+  '>': lambda expr_a, expr_b: lt(expr_b, expr_a),
+  'and': band,
+  'or': bor,
+}
+
+def compile_expr(expr, env):
+  if isinstance(expr, int):
+    return const(expr)
+  if not isinstance(expr, list):
+    if expr not in env:
+      raise Exception('unknown variable ' + str(expr))
+    return load(env[expr])
+
+  if not expr:
+    raise Exception('empty expression')
+  op, args = expr[0], expr[1:]
+  if op == 'read' and not args:
+    return read()
+  if not args:
+    # (x) is x, as in (while (1) ...)
+    return compile_expr(op, env)
+  if op == 'load' and len(args) == 1:
+    if isinstance(args[0], int):
+      return load(args[0])
+    return load_dyn(compile_expr(args[0], env))
+  if op == 'not' and len(args) == 1:
+    return bnot(compile_expr(args[0], env))
+  if op in OPERATORS and len(args) == 2:
+    return OPERATORS[op](compile_expr(args[0], env), compile_expr(args[1], env))
+  raise Exception('unknown expression ' + str(expr))
+
+def compile_block(exprs, env, variables):
+  return blck(*[compile_statement(expr, env, variables) for expr in exprs])
+
+def compile_statement(expr, env, variables):
+  """ Compiles one statement. `env` maps the variables in scope to
+  their addresses; `variables` maps every variable of the program to
+  its address, with names made unique, and grows with every `let`. """
+  op = expr[0] if isinstance(expr, list) and expr else None
+  args = expr[1:] if op else []
+
+  if op == 'print' and len(args) == 1:
+    return prnt(compile_expr(args[0], env))
+
+  if op == 'store' and len(args) == 2:
+    if isinstance(args[0], int):
+      return assign(args[0], compile_expr(args[1], env))
+    return assign_dyn(compile_expr(args[0], env), compile_expr(args[1], env))
+
+  if op == 'set' and len(args) == 2:
+    if args[0] not in env:
+      raise Exception('unknown variable ' + str(args[0]))
+    return assign(env[args[0]], compile_expr(args[1], env))
+
+  if op == 'let' and args and isinstance(args[0], list):
+    res = []
+    scope = dict(env)
+    for binding in args[0]:
+      if not isinstance(binding, list) or len(binding) != 2:
+        raise Exception('bad let binding ' + str(binding))
+      name, val_expr = binding
+      unique = name
+      while unique in variables:
+        unique += "'"
+      variables[unique] = REGISTERS + len(variables)
+      # the value is evaluated in the scope outside the let
+      res.extend(assign(variables[unique], compile_expr(val_expr, env)))
+      scope[name] = variables[unique]
+    res.extend(compile_block(args[1:], scope, variables))
+    return res
+
+  if op == 'if' and len(args) in (2, 3):
+    branches = [compile_statement(arg, env, variables) for arg in args[1:]]
+    return if_expr(compile_expr(args[0], env), *branches)
+
+  if op == 'cond':
+    arms = []
+    for arm in args:
+      if not isinstance(arm, list) or not arm:
+        raise Exception('bad cond arm ' + str(arm))
+      if arm[0] == 'else':
+        arms.append(compile_block(arm[1:], env, variables))
+      else:
+        arms.append((compile_expr(arm[0], env), compile_block(arm[1:], env, variables)))
+    return cond(*arms)
+
+  if op == 'while' and args:
+    return while_expr(compile_expr(args[0], env), compile_block(args[1:], env, variables))
+
+  if op == 'begin':
+    return compile_block(args, env, variables)
+
+  res = compile_expr(expr, env)
+  res.append(('pop', None))
+  return res
+
+def compile_program(source):
+  """ Compiles the S-expression statements of `source` to SM code.
+
+  Returns the SM code and a dict of variable names to addresses, like
+  `addr`; its size is the `usr_mem_size` for `sm_to_brainfuck`. """
+  variables = {}
+  code = compile_block(read_all(iter_tokens(source)), {}, variables)
+  return code, variables
+
+def compile_file(path):
+  with open(path) as f:
+    return compile_program(f.read())
+
+
+
 addr = {
   'memory': 4,  'm1': 5,  'm2': 6,  'm3': 7,  'm4': 8,  'm5': 9, 'm6': 10,   # memory tape
   'program': 11, 'p1': 12, 'p2': 13, 'p3': 14, 'p4': 15, 'p5': 16, 'p6': 17, # program tape
@@ -245,191 +438,193 @@ bf_in_bf_code = blck(
     blck(
       assign(a('curr_instr'), load_dyn(load(a('p_ptr')))),
       
-      # DECREMENT: 0
-      if_expr(
-        eq(load(a('curr_instr')), const(0)),
-        blck(
-          # curr_mem = *mem_ptr + 1
-          assign(
-            a('curr_mem'),
-            subtract(load_dyn(load(a('m_ptr'))), const(1))
-          ),
-          # *m_ptr = curr_mem
-          assign_dyn(
-            load(a('m_ptr')),
-            load(a('curr_mem'))
-          ),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
-        )
-      ),
-
-      # INCREMENT: 1
-      if_expr(
-        eq(load(a('curr_instr')), const(1)),
-        blck(
-          # curr_mem = *mem_ptr - 1
-          assign(
-            a('curr_mem'),
-            add(load_dyn(load(a('m_ptr'))), const(1))
-          ),
-          # *m_ptr = curr_mem
-          assign_dyn(
-            load(a('m_ptr')),
-            load(a('curr_mem'))
-          ),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
-        )
-      ),
+      cond(
+        # DECREMENT: 0
+        (
+          eq(load(a('curr_instr')), const(0)),
+          blck(
+            # curr_mem = *mem_ptr + 1
+            assign(
+              a('curr_mem'),
+              subtract(load_dyn(load(a('m_ptr'))), const(1))
+            ),
+            # *m_ptr = curr_mem
+            assign_dyn(
+              load(a('m_ptr')),
+              load(a('curr_mem'))
+            ),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          )
+        ),
 
-      # MOVE LEFT: 2
-      if_expr(
-        eq(load(a('curr_instr')), const(2)),
-        blck(
-          assign(
-            a('m_ptr'),
-            subtract(load(a('m_ptr')), const(1))
-          ),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
-        )
-      ),
+        # INCREMENT: 1
+        (
+          eq(load(a('curr_instr')), const(1)),
+          blck(
+            # curr_mem = *mem_ptr - 1
+            assign(
+              a('curr_mem'),
+              add(load_dyn(load(a('m_ptr'))), const(1))
+            ),
+            # *m_ptr = curr_mem
+            assign_dyn(
+              load(a('m_ptr')),
+              load(a('curr_mem'))
+            ),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          )
+        ),
 
-      # MOVE RIGHT: 3
-      if_expr(
-        eq(load(a('curr_instr')), const(3)),
-        blck(
-          assign(
-            a('m_ptr'),
-            add(load(a('m_ptr')), const(1))
-          ),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
-        )
-      ),
+        # MOVE LEFT: 2
+        (
+          eq(load(a('curr_instr')), const(2)),
+          blck(
+            assign(
+              a('m_ptr'),
+              subtract(load(a('m_ptr')), const(1))
+            ),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          )
+        ),
 
-      # READ: 4
-      if_expr(
-        eq(load(a('curr_instr')), const(4)),
-        blck(
-          assign_dyn(
-            load(a('m_ptr')),
-            read()
-          ),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
-        )
-      ),
+        # MOVE RIGHT: 3
+        (
+          eq(load(a('curr_instr')), const(3)),
+          blck(
+            assign(
+              a('m_ptr'),
+              add(load(a('m_ptr')), const(1))
+            ),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          )
+        ),
 
-      # WRITE: 5
-      if_expr(
-        eq(load(a('curr_instr')), const(5)),
-        blck(
-          prnt(load_dyn(load(a('m_ptr')))),
-          assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+        # READ: 4
+        (
+          eq(load(a('curr_instr')), const(4)),
+          blck(
+            assign_dyn(
+              load(a('m_ptr')),
+              read()
+            ),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          )
         ),
-      ),
 
-      # LEFT BRACKET: 6, 8, 10
-      if_expr(
-        bor3(
-          eq(load(a('curr_instr')), const(6)),
-          eq(load(a('curr_instr')), const(8)),
-          eq(load(a('curr_instr')), const(10))
+        # WRITE: 5
+        (
+          eq(load(a('curr_instr')), const(5)),
+          blck(
+            prnt(load_dyn(load(a('m_ptr')))),
+            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+          ),
         ),
-        blck(
-          #  mem[mem_ptr] == 0, find matching paren, else go right one
-          if_expr(
-            eq(load_dyn(load(a('m_ptr'))), const(0)),
-
-            # then:
-            blck(
-              # If we're at `6`:
-              #   find matching `7`
-              if_expr(
-                eq(load(a('curr_instr')), const(6)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(7)),
-                  blck(
+
+        # LEFT BRACKET: 6, 8, 10
+        (
+          bor3(
+            eq(load(a('curr_instr')), const(6)),
+            eq(load(a('curr_instr')), const(8)),
+            eq(load(a('curr_instr')), const(10))
+          ),
+          blck(
+            #  mem[mem_ptr] == 0, find matching paren, else go right one
+            if_expr(
+              eq(load_dyn(load(a('m_ptr'))), const(0)),
+
+              # then:
+              cond(
+                # If we're at `6`:
+                #   find matching `7`
+                (
+                  eq(load(a('curr_instr')), const(6)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(7)),
+                    blck(
+                      assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+                    ),
+                  )
+                ),
+
+                # If we're at `8`:
+                #   find matching `9`
+                (
+                  eq(load(a('curr_instr')), const(8)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(9)),
                     assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
                   ),
-                )
-              ),
-
-              # If we're at `8`:
-              #   find matching `9`
-              if_expr(
-                eq(load(a('curr_instr')), const(8)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(9)),
-                  assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
                 ),
-              ),
 
-              # If we're at `10`:
-              #   find matching `11`
-              if_expr(
-                eq(load(a('curr_instr')), const(10)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(11)),
-                  assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+                # If we're at `10`:
+                #   find matching `11`
+                (
+                  eq(load(a('curr_instr')), const(10)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(11)),
+                    assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+                  ),
                 ),
               ),
-            ),
 
-            # else:
-            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+              # else:
+              assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+            )
           )
-        )
-      ),
-
-      # RIGHT BRACKET: 7, 9, 11
-      if_expr(
-        bor3(
-          eq(load(a('curr_instr')), const(7)),
-          eq(load(a('curr_instr')), const(9)),
-          eq(load(a('curr_instr')), const(11))
         ),
-        blck(
-          # If mem[mem_ptr] == 0, then go right, else find the matching paren
-          if_expr(
-            eq(load_dyn(load(a('m_ptr'))), const(0)),
 
-            # then:
-            assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+        # RIGHT BRACKET: 7, 9, 11
+        (
+          bor3(
+            eq(load(a('curr_instr')), const(7)),
+            eq(load(a('curr_instr')), const(9)),
+            eq(load(a('curr_instr')), const(11))
+          ),
+          blck(
+            # If mem[mem_ptr] == 0, then go right, else find the matching paren
+            if_expr(
+              eq(load_dyn(load(a('m_ptr'))), const(0)),
+
+              # then:
+              assign(a('p_ptr'), add(load(a('p_ptr')), const(1))),
+
+              # else:
+              cond(
+                # If we're at `7`:
+                #   find matching `6`
+                (
+                  eq(load(a('curr_instr')), const(7)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(6)),
+                    blck(
+                      assign(a('p_ptr'), subtract(load(a('p_ptr')), const(1))),
+                    ),
+                  )
+                ),
 
-            # else:
-            blck(
-              # If we're at `7`:
-              #   find matching `6`
-              if_expr(
-                eq(load(a('curr_instr')), const(7)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(6)),
-                  blck(
+                # If we're at `9`:
+                #   find matching `8`
+                (
+                  eq(load(a('curr_instr')), const(9)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(8)),
                     assign(a('p_ptr'), subtract(load(a('p_ptr')), const(1))),
                   ),
-                )
-              ),
-
-              # If we're at `9`:
-              #   find matching `8`
-              if_expr(
-                eq(load(a('curr_instr')), const(9)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(8)),
-                  assign(a('p_ptr'), subtract(load(a('p_ptr')), const(1))),
                 ),
-              ),
 
-              # If we're at `10`:
-              #   find matching `11`
-              if_expr(
-                eq(load(a('curr_instr')), const(11)),
-                while_expr(
-                  neq(load_dyn(load(a('p_ptr'))), const(10)),
-                  assign(a('p_ptr'), subtract(load(a('p_ptr')), const(1))),
+                # If we're at `10`:
+                #   find matching `11`
+                (
+                  eq(load(a('curr_instr')), const(11)),
+                  while_expr(
+                    neq(load_dyn(load(a('p_ptr'))), const(10)),
+                    assign(a('p_ptr'), subtract(load(a('p_ptr')), const(1))),
+                  ),
                 ),
-              ),
-            ),            
-          ),
-        )
+              ),            
+            ),
+          )
+        ),
       ),
     )
   )
@@ -439,19 +634,30 @@ bf_in_bf_code = blck(
 # Execute
 
 from brain_machine import sm_to_brainfuck
-from bf import Brainfuck
+from bf import Brainfuck, PROFILE_ANNOTATIONS
+from sm_optimizer import optimize
+
+if __name__ == '__main__':
+  import sys
+
+  # python lisp.py [program.lisp]
+  if len(sys.argv) > 1:
+    sm_code, variables = compile_file(sys.argv[1])
+    bf_code = sm_to_brainfuck(optimize(sm_code), usr_mem_size=len(variables))
+  else:
+    bf_code = sm_to_brainfuck(optimize(bf_in_bf_code), usr_mem_size=len(addr))
 
-bf_code = sm_to_brainfuck(bf_in_bf_code, usr_mem_size=len(addr), stack_size=20)
+  machine = Brainfuck(bf_code, profile=PROFILE_ANNOTATIONS)
+  machine.input = []
+  machine.run()
 
-machine = Brainfuck(bf_code)
-machine.input = []
-machine.run()
+  print machine
 
-print machine
+  # profiler
+  # machine.print_profile()
 
-# profiler
-# for a1, a2 in zip(machine.annotations, machine.annotations[1:]):
-#   start = a1[0]
-#   end = a2[0]
-#   slice = machine.execution_log[start:end]
-#   print a1[1], sum(slice)
\ No newline at end of file
+  # results only, without BF:
+  # from stack_machine import StackMachine
+  # sm = StackMachine(bf_in_bf_code, verbose=False)
+  # sm.run()
+  # print sm.output
\ No newline at end of file
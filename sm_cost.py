@@ -0,0 +1,220 @@
+""" Estimates the BF code size and executed steps of an SM program
+without running it.
+
+The code size is exact: it is the length of the code `brain_machine`
+generates for every instruction. For the steps, the program is walked
+once, tracking the stack depth and a value range for every stack slot
+and variable. Every instruction is then timed on its own, on a tape
+set up for that depth and those values: once with the low ends of the
+ranges and once with the high ends. Loops are walked once; the totals
+assume every loop runs `loop_iterations` times. Blocks that end in
+`push 0, jbnz`, the ifs of lisp.py, run at most once and are counted
+once.
+
+  report = estimate(code, usr_mem_size=18, stack_size=20,
+                    ranges={a('m_ptr'): (0, 6)})
+  print_estimate(report)
+"""
+from bf import Brainfuck, PROFILE_ANNOTATIONS, WRAPPING, split_annotated_line
+from brain_machine import BOOLEAN, CodeGenHigh, DEFAULT_LAYOUT, MAX_VALUE, MEM, REG_B, SP, STACK_EFFECTS, emit
+
+def code_size(code):
+  return len(split_annotated_line(code.strip())[1])
+
+def stack_cell(layout, usr_mem_size, stack_size, depth):
+  """ The index of the cell of the stack top at `depth`. """
+  cell = 0
+  for region, size in layout.regions(usr_mem_size, stack_size):
+    if region == 'stack':
+      return cell + depth
+    cell += size
+
+def measure_steps(code, layout, usr_mem_size, stack_size, depth, stack, variables):
+  """ Runs the code of a single instruction on a tape as `init` would
+  leave it, but with the stack `depth` deep and holding `stack` (top
+  last), and the variables set to `variables`. Returns the steps. """
+  tape = layout.tape(usr_mem_size, stack_size)
+  width = layout.width
+  bottom = stack_cell(layout, usr_mem_size, stack_size, 0)
+  top = bottom + depth
+
+  machine = Brainfuck(code, mode=WRAPPING, tape_size=(top + 16) * width, profile=PROFILE_ANNOTATIONS)
+  memory = machine.memory
+  memory[:len(tape)] = bytearray(tape)
+
+  # move the stack pointer from the bottom to the top
+  memory[bottom * width + layout.offset(SP)] = 1
+  memory[top * width + layout.offset(SP)] = 0
+
+  for addr, value in variables.items():
+    memory[layout.cell(addr) * width + layout.offset(MEM)] = value
+  for i, value in enumerate(reversed(stack)):
+    memory[(top - i) * width + layout.offset(MEM)] = value
+
+  machine.pointer = top * width + layout.offset(SP)
+  machine.input = [0]
+  machine.run()
+  return sum(machine.execution_log)
+
+def value_range(cmd, arg, operands, variables):
+  """ The range of the value an instruction leaves on the stack. """
+  if cmd == 'push':
+    return (arg, arg)
+  if cmd == 'load':
+    return variables.get(arg, (0, 0))
+  if cmd == 'read':
+    return (0, MAX_VALUE)
+  if cmd in BOOLEAN:
+    return (0, 1)
+  (x_low, x_high), (y_low, y_high) = operands
+  if cmd == 'add':
+    return (min(x_low + y_low, MAX_VALUE), min(x_high + y_high, MAX_VALUE))
+  if cmd == 'subtract':
+    return (max(x_low - y_high, 0), max(x_high - y_low, 0))
+
+def operand_values(cmd, stack, end):
+  """ The low or high ends (`end` 0 or 1) of the stack ranges, with
+  `subtract` kept from going below zero. """
+  values = [r[end] for r in stack]
+  if cmd == 'subtract' and len(values) >= 2:
+    values[-1] = min(values[-1], values[-2])
+  return values
+
+def if_blocks(sm_code):
+  """ The indexes of the `jfz`s whose block can't loop, since it ends
+  in `push 0, jbnz`. """
+  blocks = set()
+  open_loops = []
+  for i, (cmd, arg) in enumerate(sm_code):
+    if cmd == 'jfz':
+      open_loops.append(i)
+    elif cmd == 'jbnz':
+      start = open_loops.pop()
+      if i and sm_code[i - 1] == ('push', 0):
+        blocks.add(start)
+  return blocks
+
+def estimate(sm_code, usr_mem_size, stack_size, ranges=None, loop_iterations=10, layout=None):
+  """ Estimates the cost of the BF code of `sm_code`.
+
+  `ranges` maps variable addresses to the `(low, high)` range of their
+  values over the whole run. Variables without a range start at zero
+  and take the range of whatever is stored to them, e.g. REG_B before
+  a `loadrb`.
+
+  Returns a dict with:
+
+  - `instructions`: per instruction, its loop `level` (ifs don't
+    count), stack `depth`, code `size` and the `steps_low` and
+    `steps_high` of one execution
+  - `levels`: per loop nesting level, the size and the steps of one
+    pass over the instructions at that level
+  - `size`, `steps_low` and `steps_high` of the whole program
+  """
+  layout = layout or DEFAULT_LAYOUT
+  high_code_gen = CodeGenHigh(layout)
+  fixed = dict(ranges or {})
+  variables = dict(fixed)
+
+  init = Brainfuck(high_code_gen.init(usr_mem_size, stack_size), profile=PROFILE_ANNOTATIONS)
+  init.run()
+  init_steps = sum(init.execution_log)
+  report = {
+    'instructions': [],
+    'levels': {},
+    'size': len(init.code),
+    'steps_low': init_steps,
+    'steps_high': init_steps
+  }
+
+  stack = [] # value ranges, top last
+  level = 0
+  measured = {}
+  ifs = if_blocks(sm_code)
+  blocks = [] # whether each open `jfz` starts a loop
+
+  for i, (cmd, arg) in enumerate(sm_code):
+    code = emit(high_code_gen, cmd, arg)
+    size = code_size(code)
+    if cmd in ('jfz', 'jbnz'):
+      # half a loop can't run on its own; neither has inner loops
+      steps = (size, size)
+    else:
+      steps = []
+      for end in (0, 1):
+        values = operand_values(cmd, stack, end)
+        var_values = dict((addr, r[end]) for addr, r in variables.items())
+        key = (cmd, arg, len(stack), tuple(values), tuple(sorted(var_values.items())))
+        if key not in measured:
+          measured[key] = measure_steps(code, layout, usr_mem_size, stack_size, len(stack), values, var_values)
+        steps.append(measured[key])
+
+    report['instructions'].append({
+      'cmd': cmd,
+      'arg': arg,
+      'level': level,
+      'depth': len(stack),
+      'size': size,
+      'steps_low': steps[0],
+      'steps_high': steps[1]
+    })
+
+    totals = report['levels'].setdefault(level, {'size': 0, 'steps_low': 0, 'steps_high': 0})
+    totals['size'] += size
+    totals['steps_low'] += steps[0]
+    totals['steps_high'] += steps[1]
+    report['size'] += size
+    report['steps_low'] += steps[0] * loop_iterations ** level
+    report['steps_high'] += steps[1] * loop_iterations ** level
+
+    # update the stack and the variables
+    effect = STACK_EFFECTS[cmd]
+    if cmd == 'store' and arg not in fixed:
+      variables[arg] = stack[-1] if stack else (0, 0)
+    elif cmd == 'storerb':
+      low, high = variables.get(REG_B, (0, 0))
+      for addr in xrange(low, high + 1):
+        if addr not in fixed:
+          variables[addr] = stack[-1] if stack else (0, 0)
+    elif cmd == 'loadrb' and REG_B not in fixed:
+      # REG_B now holds any of the values it could point at
+      low, high = variables.get(REG_B, (0, 0))
+      values = [variables.get(addr, (0, 0)) for addr in xrange(low, high + 1)]
+      variables[REG_B] = (min(v[0] for v in values), max(v[1] for v in values))
+
+    if effect > 0:
+      stack.append(value_range(cmd, arg, None, variables))
+    elif cmd == 'pop':
+      stack.pop()
+    elif cmd in ('add', 'subtract', 'band', 'bandb', 'borb', 'gte'):
+      operands = stack[-2:]
+      del stack[-2:]
+      stack.append(value_range(cmd, arg, operands, variables))
+    elif cmd == 'bnot':
+      stack[-1] = (0, 1)
+
+    # `jfz` runs once per loop, `jbnz` once per iteration
+    if cmd == 'jfz':
+      blocks.append(i not in ifs)
+      if blocks[-1]:
+        level += 1
+    elif cmd == 'jbnz':
+      if blocks.pop():
+        level -= 1
+
+  return report
+
+def print_estimate(report, per_instruction=False):
+  if per_instruction:
+    print '%-6s %-10s %6s %5s %6s %10s %10s' % ('index', 'instr', 'level', 'depth', 'size', 'steps low', 'steps high')
+    for i, instr in enumerate(report['instructions']):
+      name = instr['cmd'] + ('' if instr['arg'] is None else ' ' + str(instr['arg']))
+      print '%-6d %-10s %6d %5d %6d %10d %10d' % (
+        i, name, instr['level'], instr['depth'], instr['size'],
+        instr['steps_low'], instr['steps_high'])
+    print
+
+  print '%-6s %8s %12s %12s' % ('level', 'size', 'steps low', 'steps high')
+  for level, totals in sorted(report['levels'].items()):
+    print '%-6d %8d %12d %12d' % (level, totals['size'], totals['steps_low'], totals['steps_high'])
+  print '%-6s %8d %12d %12d' % ('total', report['size'], report['steps_low'], report['steps_high'])
@@ -0,0 +1,403 @@
+""" Optimization passes over SM code, such as the output of the
+lisp.py combinators. Every pass takes and returns a list of SM
+instructions; `optimize` runs all of them.
+"""
+from brain_machine import BOOLEAN, MAX_VALUE, REG_B, STACK_EFFECTS
+
+# Instructions that read the stack top without consuming it
+OBSERVERS = ('store', 'storerb', 'prnt', 'jfz', 'jbnz')
+
+class Value(object):
+  """ What is known about a stack value. `bnot_at` is the index of
+  the `bnot` in the output that produced it, with `negated` the value
+  it negated. An `observed` value was read by an instruction other
+  than the one consuming it, so the instruction producing it must
+  stay. """
+  def __init__(self, boolean, bnot_at=None, negated=None):
+    self.boolean = boolean
+    self.bnot_at = bnot_at
+    self.negated = negated
+    self.observed = False
+
+def optimize_booleans(sm_code):
+  """ Tracks which stack values are known to be 0 or 1, and for those:
+
+  - drops `bnot bnot`, which only turns a value into 0 or 1
+  - lowers `band` to the constant time `bandb`
+  - lowers `bnot(band(bnot(a), bnot(b)))`, the `bor` of lisp.py, to
+    `borb(a, b)`
+
+  Values that are live across a `jfz` or `jbnz` are left alone.
+  """
+  sm_code = list(sm_code)
+  out = []
+  stack = []
+  loops = []
+  skip = False
+
+  for i, (cmd, arg) in enumerate(sm_code):
+    if skip:
+      skip = False
+      continue
+
+    if cmd == 'bnot':
+      top = stack[-1]
+      if top.negated and top.negated.boolean and top.bnot_at == len(out) - 1 and not top.observed:
+        out.pop()
+        stack[-1] = top.negated
+      else:
+        out.append((cmd, arg))
+        stack[-1] = Value(True, len(out) - 1, top)
+      continue
+
+    if cmd == 'band':
+      y = stack.pop()
+      x = stack.pop()
+      if x.boolean and y.boolean:
+        negations = (x.negated, y.negated)
+        if i + 1 < len(sm_code) and sm_code[i + 1][0] == 'bnot' and \
+           x.bnot_at is not None and y.bnot_at is not None and \
+           not x.observed and not y.observed and \
+           all(n and n.boolean for n in negations):
+          # not(not a and not b) = a or b
+          out[x.bnot_at] = None
+          out[y.bnot_at] = None
+          out.append(('borb', None))
+          skip = True
+        else:
+          out.append(('bandb', None))
+      else:
+        out.append((cmd, arg))
+      stack.append(Value(True))
+      continue
+
+    out.append((cmd, arg))
+
+    if cmd in OBSERVERS and stack:
+      stack[-1].observed = True
+
+    if cmd == 'jfz':
+      # values live across the loop can't be rewritten
+      for value in stack:
+        value.observed = True
+      loops.append(list(stack))
+    elif cmd == 'jbnz':
+      # the stack after the loop comes from either end of it
+      entry = loops.pop()
+      for depth, (before, after) in enumerate(zip(entry, stack)):
+        if before is not after:
+          stack[depth] = Value(before.boolean and after.boolean)
+        stack[depth].observed = True
+    elif cmd == 'push':
+      stack.append(Value(arg in (0, 1)))
+    elif cmd == 'pop':
+      stack.pop()
+    elif STACK_EFFECTS[cmd] == -1:
+      del stack[-2:]
+      stack.append(Value(cmd in BOOLEAN))
+    elif STACK_EFFECTS[cmd] == 1:
+      stack.append(Value(False))
+
+  return [instr for instr in out if instr is not None]
+
+FOLDS = {
+  'add': lambda x, y: x + y,
+  'subtract': lambda x, y: x - y,
+  'gte': lambda x, y: 1 if x >= y else 0,
+  'band': lambda x, y: 1 if x and y else 0,
+  'bandb': lambda x, y: x & y,
+  'borb': lambda x, y: x | y,
+}
+
+class Slot(object):
+  """ A stack value while folding: its `value` if known, and where its
+  code starts in the output. The code of a `pure` slot, from `start`
+  to the next slot, can be dropped without losing side effects. """
+  def __init__(self, value, start, pure=True):
+    self.value = value
+    self.start = start
+    self.pure = pure
+
+def loop_stores(sm_code):
+  """ For every `jfz`, by index, the addresses written before its
+  `jbnz`, or `None` when a `storerb` can write anywhere. """
+  stores = {}
+  open_loops = []
+  for i, (cmd, arg) in enumerate(sm_code):
+    if cmd == 'jfz':
+      open_loops.append(i)
+      stores[i] = set()
+    elif cmd == 'jbnz':
+      open_loops.pop()
+    elif cmd in ('store', 'loadrb', 'storerb'):
+      for j in open_loops:
+        if cmd == 'storerb' or stores[j] is None:
+          stores[j] = None
+        else:
+          stores[j].add(REG_B if cmd == 'loadrb' else arg)
+  return stores
+
+def fold_constants(sm_code):
+  """ Computes what can be computed before running: `load` of a cell
+  with a known value becomes a `push`, and arithmetic, comparisons and
+  `bnot` on pushed values become a single `push`. Pure values that are
+  only popped are dropped.
+
+  Memory starts out zero. A loop forgets the cells it writes to, and
+  the stack values it was entered with, both inside and after it. The
+  code of values that are stored or printed stays. Results outside 0
+  to MAX_VALUE are not folded.
+  """
+  sm_code = list(sm_code)
+  stores = loop_stores(sm_code)
+  out = []
+  stack = []
+  memory = {} # known values, by address
+  zeroed = True # whether the addresses not in `memory` are still 0
+  loops = [] # (memory, zeroed) at the open `jfz`s
+
+  def known(addr):
+    if addr in memory:
+      return memory[addr]
+    return 0 if zeroed else None
+
+  for i, (cmd, arg) in enumerate(sm_code):
+    start = len(out)
+
+    if cmd in FOLDS or cmd == 'bnot':
+      operands = stack[-2:] if cmd in FOLDS else stack[-1:]
+      del stack[-len(operands):]
+      values = [slot.value for slot in operands]
+      value = None
+      if None not in values:
+        value = FOLDS[cmd](*values) if cmd in FOLDS else (0 if values[0] else 1)
+        if not 0 <= value <= MAX_VALUE:
+          value = None
+      if value is not None and all(slot.pure for slot in operands):
+        del out[operands[0].start:]
+        out.append(('push', value))
+        stack.append(Slot(value, operands[0].start))
+      else:
+        out.append((cmd, arg))
+        stack.append(Slot(value, operands[0].start, all(slot.pure for slot in operands)))
+      continue
+
+    if cmd == 'pop':
+      top = stack.pop()
+      if top.pure:
+        del out[top.start:]
+      else:
+        out.append((cmd, arg))
+        # the side effects are now in the code of the value below
+        if stack:
+          stack[-1].pure = False
+      continue
+
+    if cmd == 'push':
+      out.append((cmd, arg))
+      stack.append(Slot(arg, start))
+      continue
+
+    if cmd == 'load':
+      value = known(arg)
+      out.append(('push', value) if value is not None else (cmd, arg))
+      stack.append(Slot(value, start))
+      continue
+
+    # everything else has side effects, which end up in the code of
+    # the stack top
+    out.append((cmd, arg))
+    if stack:
+      stack[-1].pure = False
+
+    if cmd == 'read':
+      stack.append(Slot(None, start, False))
+    elif cmd == 'store':
+      memory[arg] = stack[-1].value
+    elif cmd == 'loadrb':
+      addr = known(REG_B)
+      memory[REG_B] = known(addr) if addr is not None else None
+    elif cmd == 'storerb':
+      addr = known(REG_B)
+      if addr is not None:
+        memory[addr] = stack[-1].value
+      else:
+        memory = {}
+        zeroed = False
+      memory[REG_B] = 0
+    elif cmd == 'jfz':
+      if stores[i] is None:
+        memory = {}
+        zeroed = False
+      for addr in stores[i] or ():
+        memory[addr] = None
+      for slot in stack:
+        slot.value = None
+        slot.pure = False
+      loops.append((dict(memory), zeroed))
+    elif cmd == 'jbnz':
+      # the loop is left the same way whether it ran or not, with
+      # only the cells it writes to changed
+      memory, zeroed = loops.pop()
+      for slot in stack:
+        slot.value = None
+        slot.pure = False
+      stack[-1].value = 0
+
+  return out
+
+# REG_C and REG_D are free for keeping values around, unlike REG_B,
+# which `loadrb` and `storerb` use.
+SPARE_REGISTERS = (2, 3)
+
+class Expression(object):
+  """ The instructions `start` to `end` of a program that together push
+  one value. `reads` are the addresses it loads, and `dynamic` tells
+  whether it loads through `loadrb`. """
+  def __init__(self, start, end, pure, reads=(), dynamic=False):
+    self.start = start
+    self.end = end
+    self.pure = pure
+    self.reads = frozenset(reads)
+    self.dynamic = dynamic
+
+def combine(start, end, operands):
+  return Expression(start, end, all(e.pure for e in operands),
+                    frozenset().union(*[e.reads for e in operands]),
+                    any(e.dynamic for e in operands))
+
+def expressions(sm_code):
+  """ Finds the expressions of a program, by following the stack.
+  A dynamic load, as emitted by `lisp.load_dyn`:
+
+    <address expression> store 1, pop, loadrb, load 1
+
+  is one expression, since REG_B is only scratch.
+  """
+  found = []
+  stack = []
+  reg_b = None # the address expression last stored to REG_B
+
+  for i, (cmd, arg) in enumerate(sm_code):
+    if cmd == 'push':
+      value = Expression(i, i + 1, True)
+    elif cmd == 'load' and arg == REG_B:
+      if reg_b and [c for c, _ in sm_code[i - 3:i]] == ['store', 'pop', 'loadrb'] and reg_b.end == i - 3:
+        value = Expression(reg_b.start, i + 1, reg_b.pure, reg_b.reads, True)
+      else:
+        value = Expression(i, i + 1, False)
+    elif cmd == 'load':
+      value = Expression(i, i + 1, True, [arg])
+    elif cmd in ('add', 'subtract', 'gte', 'band', 'bandb', 'borb'):
+      y = stack.pop()
+      x = stack.pop()
+      value = combine(x.start, i + 1, [x, y])
+    elif cmd == 'bnot':
+      value = combine(stack[-1].start, i + 1, [stack.pop()])
+    elif cmd == 'pop':
+      stack.pop()
+      continue
+    else:
+      if cmd == 'store' and arg == REG_B:
+        # scratch, part of a dynamic load
+        reg_b = stack[-1]
+      elif cmd in ('store', 'storerb', 'prnt', 'jfz', 'jbnz') and stack:
+        # whatever is built on top of it includes this side effect
+        stack[-1].pure = False
+      if STACK_EFFECTS[cmd] > 0:
+        stack.append(Expression(i, i + 1, False))
+      continue
+
+    stack.append(value)
+    found.append(value)
+
+  return found
+
+def invalidates(instr, expression, register):
+  """ Whether `instr` changes the value of `expression`, or of the
+  register holding it. """
+  cmd, arg = instr
+  if cmd in ('jfz', 'jbnz', 'read', 'storerb'):
+    return True
+  if cmd == 'store' and arg != REG_B:
+    return arg in expression.reads or arg == register or expression.dynamic
+  return False
+
+def eliminate_common_subexpressions(sm_code):
+  """ Evaluates repeated dynamic loads once. `lisp.eq`, for one,
+  emits both of its operands twice; when an operand is a `load_dyn`,
+  every repeat is a full walk of `loadrb`. The first evaluation is
+  kept in REG_C or REG_D, and the repeats load it from there.
+
+  Only expressions with a dynamic load are worth the extra `store`.
+  A repeat is only replaced if nothing in between stores to what the
+  expression reads, and no `storerb`, `read` or jump comes between.
+  Programs using REG_C or REG_D themselves are left alone.
+  """
+  sm_code = list(sm_code)
+  if any(cmd in ('load', 'store') and arg in SPARE_REGISTERS for cmd, arg in sm_code):
+    return sm_code
+
+  def key(e):
+    return tuple(sm_code[e.start:e.end])
+
+  candidates = [e for e in expressions(sm_code) if e.pure and e.dynamic]
+  candidates.sort(key=lambda e: (e.start, -e.end))
+
+  replaced = [] # (repeat, first, register)
+  stores = {} # end of a first evaluation -> registers
+  busy = [] # [first end, last repeat start, register]
+  held = {} # start of a first evaluation -> its entry in `busy`
+
+  for repeat in candidates:
+    if any(r.start < repeat.end and repeat.start < r.end for r, _, _ in replaced):
+      continue
+    for first in reversed(candidates):
+      if first.end > repeat.start or key(first) != key(repeat):
+        continue
+      if any(r.start < first.end and first.start < r.end for r, _, _ in replaced):
+        continue
+      between = sm_code[first.end:repeat.start]
+      # a value already kept in a register stays in that one
+      own = held.get(first.start)
+      registers = [own[2]] if own else SPARE_REGISTERS
+      registers = [r for r in registers
+                   if not any(start <= repeat.start and first.end <= end and reg == r
+                              for start, end, reg in [entry for entry in busy if entry is not own])]
+      registers = [r for r in registers if not any(invalidates(instr, first, r) for instr in between)]
+      if registers:
+        register = registers[0]
+        replaced.append((repeat, first, register))
+        if own:
+          own[1] = repeat.start
+        else:
+          stores.setdefault(first.end, set()).add(register)
+          held[first.start] = [first.end, repeat.start, register]
+          busy.append(held[first.start])
+      break
+
+  starts = dict((repeat.start, (repeat, register)) for repeat, _, register in replaced)
+  out = []
+  i = 0
+  while i < len(sm_code):
+    if i in starts:
+      repeat, register = starts[i]
+      out.append(('load', register))
+      i = repeat.end
+    else:
+      out.append(sm_code[i])
+      i += 1
+    for register in sorted(stores.get(i, ())):
+      out.append(('store', register))
+  return out
+
+PASSES = [
+  fold_constants,
+  optimize_booleans,
+  eliminate_common_subexpressions,
+]
+
+def optimize(sm_code):
+  for optimization in PASSES:
+    sm_code = optimization(sm_code)
+  return sm_code
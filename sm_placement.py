@@ -0,0 +1,211 @@
+""" Profile-guided placement of variables.
+
+`load` and `store` walk from REG_A to their address and back once
+per unit copied, so a variable costs more the further it sits from
+REG_A. `place_variables` renumbers the variables of an SM program so
+that the most used ones come first:
+
+  machine = Brainfuck(sm_to_brainfuck(code, len(addr)), profile=PROFILE_ANNOTATIONS)
+  machine.run()
+  code, mapping = place_variables(code, access_counts(machine))
+
+`stack_machine.StackMachine` with `profile` gives the same counts much
+faster, and also the exact addresses reached through `loadrb` and
+`storerb`:
+
+  sm = StackMachine(code, verbose=False, profile=True)
+  sm.run()
+  code, mapping = place_variables(code, sm.accesses, sm.dynamic)
+
+Memory that is reached through `loadrb`/`storerb` is moved as one
+block, so that pointers into it stay valid; the constant addresses
+in the program that point into it are moved along.
+"""
+from brain_machine import REG_B, REGISTERS, STACK_EFFECTS
+
+def access_counts(machine):
+  """ Counts the executions of every `load` and `store` address in a
+  `Brainfuck` run with `PROFILE_ANNOTATIONS`. `loadrb` and `storerb`
+  are counted under `None`, since their addresses are not known. """
+  counts = {}
+  for start, annotation in machine.annotations:
+    annotation = annotation.rstrip(':')
+    if start >= len(machine.code):
+      continue
+    if annotation.startswith('load_addr_') or annotation.startswith('store_addr_'):
+      key = int(annotation.rsplit('_', 1)[1])
+    elif annotation in ('loadrb', 'storerb'):
+      key = None
+    else:
+      continue
+    counts[key] = counts.get(key, 0) + machine.execution_log[start]
+  return counts
+
+def trace_values(sm_code):
+  """ Follows where stack values come from. Every value is a list of
+  the `('push', index)` and `('load', addr)` terms that `add` and
+  `subtract` combined into it; other instructions start new values.
+
+  Returns the values that reach REG_B, the values stored per address,
+  and the pairs of values compared with `gte`.
+  """
+  stack = []
+  to_reg_b = []
+  stored = {}
+  compared = []
+
+  for i, (cmd, arg) in enumerate(sm_code):
+    if cmd == 'push':
+      stack.append([('push', i)])
+    elif cmd == 'load':
+      stack.append([('load', arg)])
+    elif cmd == 'store':
+      if arg == REG_B:
+        to_reg_b.append(stack[-1])
+      else:
+        stored.setdefault(arg, []).append(stack[-1])
+    elif cmd in ('add', 'subtract'):
+      y = stack.pop()
+      stack.append(stack.pop() + y)
+    elif cmd == 'gte':
+      y = stack.pop()
+      compared.append((stack.pop(), y))
+      stack.append([])
+    elif cmd == 'pop':
+      stack.pop()
+    elif STACK_EFFECTS[cmd] > 0:
+      stack.append([])
+    elif cmd in ('band', 'bandb', 'borb'):
+      del stack[-2:]
+      stack.append([])
+    elif cmd == 'bnot':
+      stack[-1] = []
+
+  return to_reg_b, stored, compared
+
+def address_constants(sm_code):
+  """ Finds the `push` instructions that push an address, and those
+  that push an offset added to an address, by their index.
+
+  A value is an address when it reaches REG_B, is stored to a pointer,
+  or is compared with an address; a pointer is a variable that is
+  loaded into an address. Within an address made of constants only,
+  the first push is the address and any further ones offsets; pushes
+  added to a pointer are offsets.
+
+  Returns the address and offset pushes, the address pushes that are
+  bases, i.e. not only compared with an address, and the pointers. """
+  to_reg_b, stored, compared = trace_values(sm_code)
+
+  addresses = list(to_reg_b)
+  bounds = [] # the addresses that are only compared with one
+  pointers = set()
+
+  def is_address(value):
+    return value in addresses or any(kind == 'load' and arg in pointers for kind, arg in value)
+
+  changed = True
+  while changed:
+    changed = False
+    for value in addresses:
+      for kind, arg in value:
+        if kind == 'load' and arg not in pointers:
+          pointers.add(arg)
+          changed = True
+    for addr in pointers:
+      for value in stored.get(addr, []):
+        if value not in addresses:
+          addresses.append(value)
+          changed = True
+    for x, y in compared:
+      if is_address(x) != is_address(y):
+        addresses.append(y if is_address(x) else x)
+        bounds.append(addresses[-1])
+        changed = True
+
+  constants = set()
+  offsets = set()
+  bases = set()
+  for value in addresses:
+    pushes = [arg for kind, arg in value if kind == 'push']
+    if any(kind == 'load' and arg in pointers for kind, arg in value):
+      offsets.update(pushes)
+    elif pushes:
+      constants.add(pushes[0])
+      offsets.update(pushes[1:])
+      if value not in bounds:
+        bases.add(pushes[0])
+  return constants, offsets, bases, pointers
+
+def place_variables(sm_code, counts, dynamic=None):
+  """ Renumbers the variables of `sm_code` by how often they are
+  accessed, the most used nearest to REG_A.
+
+  `counts` maps addresses to accesses, e.g. from `access_counts`;
+  accesses of unknown address are counted under `None`. `dynamic` is
+  the set of addresses reached through `loadrb`/`storerb`, if known.
+  Otherwise the dynamic block is inferred from the base addresses the
+  program gives to `loadrb`/`storerb` or its pointers, widened by the
+  largest constant offset on either side, and up to the bounds they
+  are compared with; this can miss pointer arithmetic done with
+  variables. Pointers themselves are kept out of the block.
+
+  The block is placed as a whole, by its accesses per cell, like the
+  single variables; constants up to one past its end move with it.
+  Registers never move.
+
+  Returns the rewritten code and a dict of old to new addresses.
+  """
+  sm_code = list(sm_code)
+  constants, offsets, bases, pointers = address_constants(sm_code)
+  base_addrs = [sm_code[i][1] for i in bases if sm_code[i][1] >= REGISTERS]
+  bound_addrs = [sm_code[i][1] for i in constants - bases if sm_code[i][1] >= REGISTERS]
+  max_offset = max([sm_code[i][1] for i in offsets] or [0])
+
+  used = set(arg for cmd, arg in sm_code if cmd in ('load', 'store') and arg >= REGISTERS)
+  if dynamic:
+    block = (min(dynamic), max(dynamic))
+  elif base_addrs:
+    start = max(min(base_addrs) - max_offset, REGISTERS)
+    # a bound is one past the end, as in `lt(load(ptr), const(end))`
+    end = max([max(base_addrs) + max_offset] + [addr - 1 for addr in bound_addrs])
+    for addr in pointers:
+      if max(base_addrs) < addr <= end:
+        end = addr - 1
+      elif start <= addr < min(base_addrs):
+        start = addr + 1
+    block = (start, end)
+  else:
+    block = None
+
+  # units to place: the block, and the variables outside it
+  units = []
+  if block:
+    start, end = block
+    weight = counts.get(None, 0) + sum(counts.get(addr, 0) for addr in xrange(start, end + 1))
+    units.append((weight, range(start, end + 1)))
+  for addr in sorted(used):
+    if not block or not block[0] <= addr <= block[1]:
+      units.append((counts.get(addr, 0), [addr]))
+
+  # most accesses per cell first; the sort is stable on ties
+  units.sort(key=lambda unit: -float(unit[0]) / len(unit[1]))
+
+  mapping = {}
+  next_addr = REGISTERS
+  for _, addrs in units:
+    for addr in addrs:
+      mapping[addr] = next_addr
+      next_addr += 1
+
+  result = []
+  for i, (cmd, arg) in enumerate(sm_code):
+    if cmd in ('load', 'store') and arg in mapping:
+      arg = mapping[arg]
+    elif i in constants and block and block[0] <= arg <= block[1] + 1:
+      arg += mapping[block[0]] - block[0]
+    elif i in constants and arg in mapping:
+      arg = mapping[arg]
+    result.append((cmd, arg))
+
+  return result, mapping
@@ -0,0 +1,34 @@
+import hashlib
+import marshal
+import os
+import zlib
+
+# Bump when the layout of saved states changes.
+SNAPSHOT_VERSION = 1
+
+def program_hash(data):
+  return hashlib.sha1(data).hexdigest()
+
+def write_atomic(path, data):
+  """ Writes to a temporary file and renames it, so that readers
+  never see half a file, even if the writer is interrupted. """
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.rename(tmp_path, path)
+
+def save_state(path, state):
+  """ Saves a dict of plain values (ints, strings, lists, tuples
+  and dicts of those) in a compact, compressed form. """
+  state = dict(state, version=SNAPSHOT_VERSION)
+  write_atomic(path, zlib.compress(marshal.dumps(state)))
+
+def load_state(path):
+  with open(path, 'rb') as f:
+    state = marshal.loads(zlib.decompress(f.read()))
+  if state.get('version') != SNAPSHOT_VERSION:
+    raise Exception('unsupported snapshot version: ' + str(state.get('version')))
+  return state
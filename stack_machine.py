@@ -1,16 +1,46 @@
 from time import sleep
 
-class StackMachine():
+from brain_machine import REG_B
+from snapshot import program_hash, save_state, load_state
+from streams import InputStream
 
-  def __init__(self, code, vars, verbose=True):
+class StackMachine():
+  """ Runs SM code directly, without going through BF, for when only
+  the results are needed. It knows every instruction of
+  `brain_machine.CodeGenHigh`, with the same semantics:
+
+  - `jfz`/`jbnz` without a target are matched like brackets, as
+    `sm_to_brainfuck` does; with a target they jump there
+  - `loadrb` loads mem[REG_B] into REG_B; `storerb` stores the stack
+    top at mem[REG_B] and clears REG_B
+  - `read` pushes the next value of `input`, see `streams.InputStream`
+
+  Addresses are either ints or names looked up in `vars`. The program
+  is resolved once into a list of closures, one per instruction, each
+  of which executes it and returns the next code pointer. The ram
+  grows as needed.
+
+  With `profile`, `accesses` counts the memory accesses per address,
+  including those of `loadrb`/`storerb`, whose addresses are also
+  collected in `dynamic`; see `sm_placement.place_variables`.
+  """
+
+  def __init__(self, code, vars=None, verbose=True, output=None, input=None, profile=False):
     self.code = code
-    self.vars = vars
+    self.vars = vars or {}
     self.verbose = verbose
+    self.profile = profile
 
     self.cp = 0
     self.ram = [0] * 10
     self.stack = []
-    self.output = []
+    self.output = output if output is not None else [] # list or OutputSink
+    self.input = input if input is not None else []
+    self.input_stream = None
+    self.accesses = {}
+    self.dynamic = set()
+
+    self.ops = self._compile()
 
 
   # Internal methods
@@ -21,78 +51,291 @@ class StackMachine():
     print 'ram', self.ram
     print
 
-  def _run(self):
-    if self.verbose:
-      print 'initial state'
-      self._print_state()
-
-    while self.cp < len(self.code):
-      instruction = self.code[self.cp]
-      name, arg = instruction[0], instruction[1]
-
-      if self.verbose:
-        print 'executing', name, 'with arg', arg
-
-      if arg is None:
-        getattr(self, name)()
-      else:
-        getattr(self, name)(arg)
+  def _program_hash(self):
+    return program_hash(repr((self.code, sorted(self.vars.items()))))
 
+  def snapshot(self, path):
+    """ Saves the execution state, see `bf.Brainfuck.snapshot`. """
+    if isinstance(self.output, list):
+      output, output_count = self.output, len(self.output)
+    else:
+      output, output_count = None, self.output.count
+
+    save_state(path, {
+      'program_hash': self._program_hash(),
+      'cp': self.cp,
+      'ram': self.ram,
+      'stack': self.stack,
+      'input_offset': self.input_stream.offset if self.input_stream else 0,
+      'output': output,
+      'output_count': output_count
+    })
+
+  def restore(self, path):
+    state = load_state(path)
+    if state['program_hash'] != self._program_hash():
+      raise Exception('snapshot belongs to a different program')
+
+    # in place, the compiled instructions hold on to these lists
+    self.cp = state['cp']
+    self.ram[:] = state['ram']
+    self.stack[:] = state['stack']
+    self.input_stream = InputStream(self.input, offset=state.get('input_offset', 0))
+    if state['output'] is not None and isinstance(self.output, list):
+      self.output = state['output']
+
+  def _address(self, arg):
+    return self.vars[arg] if isinstance(arg, basestring) else arg
+
+  def _jump_targets(self):
+    """ Matches the structured `jfz`/`jbnz` pairs. Each jumps to the
+    instruction after its partner. """
+    targets = {}
+    loops = []
+    for cp, (name, arg) in enumerate(self.code):
+      if name == 'jfz' and arg is None:
+        loops.append(cp)
+      elif name == 'jbnz' and arg is None:
+        if not loops:
+          raise Exception('jbnz without jfz at instruction ' + str(cp))
+        start = loops.pop()
+        targets[start] = cp + 1
+        targets[cp] = start + 1
+    if loops:
+      raise Exception('jfz without jbnz')
+    return targets
+
+  def _compile(self):
+    targets = self._jump_targets()
+
+    addresses = [self._address(arg) for name, arg in self.code if name in ('load', 'store')]
+    if addresses and max(addresses) >= len(self.ram):
+      self.ram.extend([0] * (max(addresses) + 1 - len(self.ram)))
+
+    ops = []
+    for cp, (name, arg) in enumerate(self.code):
+      if name in ('load', 'store'):
+        arg = self._address(arg)
+      elif name in ('jfz', 'jbnz'):
+        arg = targets[cp] if arg is None else arg
+      if self.profile and name in ('load', 'store', 'loadrb', 'storerb'):
+        name = 'profiled_' + name
+      factory = getattr(self, '_op_' + name, None)
+      if factory is None:
+        raise Exception('unknown instruction: ' + str(name))
+      ops.append(factory(arg, cp + 1))
+    return ops
+
+  def _grow_ram(self, addr):
+    if addr >= len(self.ram):
+      self.ram.extend([0] * (addr + 1 - len(self.ram)))
+
+  def _read(self):
+    if self.input_stream is None or self.input_stream.source is not self.input:
+      self.input_stream = InputStream(self.input)
+    return self.input_stream.read()
+
+  def _count(self, addr, dynamic=False):
+    self.accesses[addr] = self.accesses.get(addr, 0) + 1
+    if dynamic:
+      self.dynamic.add(addr)
+
+  def _run(self, checkpoint_every=None, checkpoint_path=None):
+    ops = self.ops
+    end = len(ops)
+
+    if self.verbose or checkpoint_every:
       if self.verbose:
+        print 'initial state'
         self._print_state()
 
-  def _next(self):
-    self.cp += 1
-    
-  def _set_cp(self, cp):
-    self.cp = cp
-
+      steps = 0
+      while self.cp < end:
+        if self.verbose:
+          print 'executing', self.code[self.cp][0], 'with arg', self.code[self.cp][1]
 
-  # SM instructions
+        self.cp = ops[self.cp]()
 
-  def push(self, val):
-    self.stack.append(val)
-    self._next()
+        if self.verbose:
+          self._print_state()
 
-  def pop(self):
-    self.stack.pop()
-    self._next()
-
-  def load(self, var):
-    location = self.vars[var]
-    self.stack.append(self.ram[location])
-    self._next()
-
-  def store(self, var):
-    location = self.vars[var]
-    self.ram[location] = self.stack[-1]
-    self._next()
-
-  def jfz(self, cp):
-    if self.stack[-1] == 0:
-      self._set_cp(cp)
-    else:
-      self._next()
-
-  def jbnz(self, cp):
-    if self.stack[-1] != 0:
-      self._set_cp(cp)
+        steps += 1
+        if checkpoint_every and steps % checkpoint_every == 0:
+          self.snapshot(checkpoint_path)
     else:
-      self._next()
-
-  def add(self):
-    self.stack.append(self.stack.pop() + self.stack.pop())
-    self._next()
-
-  def subtract(self):
-    b = self.stack.pop()
-    a = self.stack.pop()
-    self.stack.append(a - b)
-    self._next()
-
-  def prnt(self):
-    self.output.append(self.stack[-1])
-    self._next()
+      cp = self.cp
+      try:
+        while cp < end:
+          cp = ops[cp]()
+      finally:
+        self.cp = cp
+
+    if hasattr(self.output, 'flush'):
+      self.output.flush()
+
+  run = _run
+
+
+  # SM instructions, as closures returning the next code pointer
+
+  def _op_push(self, val, next_cp):
+    append = self.stack.append
+    def push():
+      append(val)
+      return next_cp
+    return push
+
+  def _op_pop(self, _, next_cp):
+    pop = self.stack.pop
+    def pop_():
+      pop()
+      return next_cp
+    return pop_
+
+  def _op_add(self, _, next_cp):
+    stack = self.stack
+    def add():
+      y = stack.pop()
+      stack[-1] += y
+      return next_cp
+    return add
+
+  def _op_subtract(self, _, next_cp):
+    stack = self.stack
+    def subtract():
+      y = stack.pop()
+      stack[-1] -= y
+      return next_cp
+    return subtract
+
+  def _op_gte(self, _, next_cp):
+    stack = self.stack
+    def gte():
+      y = stack.pop()
+      stack[-1] = 1 if stack[-1] >= y else 0
+      return next_cp
+    return gte
+
+  def _op_band(self, _, next_cp):
+    stack = self.stack
+    def band():
+      y = stack.pop()
+      stack[-1] = 1 if stack[-1] and y else 0
+      return next_cp
+    return band
+
+  def _op_bandb(self, _, next_cp):
+    stack = self.stack
+    def bandb():
+      y = stack.pop()
+      stack[-1] &= y
+      return next_cp
+    return bandb
+
+  def _op_borb(self, _, next_cp):
+    stack = self.stack
+    def borb():
+      y = stack.pop()
+      stack[-1] |= y
+      return next_cp
+    return borb
+
+  def _op_bnot(self, _, next_cp):
+    stack = self.stack
+    def bnot():
+      stack[-1] = 0 if stack[-1] else 1
+      return next_cp
+    return bnot
+
+  def _op_prnt(self, _, next_cp):
+    stack = self.stack
+    def prnt():
+      self.output.append(stack[-1])
+      return next_cp
+    return prnt
+
+  def _op_read(self, _, next_cp):
+    append = self.stack.append
+    def read():
+      append(self._read())
+      return next_cp
+    return read
+
+  def _op_load(self, addr, next_cp):
+    append = self.stack.append
+    ram = self.ram
+    def load():
+      append(ram[addr])
+      return next_cp
+    return load
+
+  def _op_store(self, addr, next_cp):
+    stack = self.stack
+    ram = self.ram
+    def store():
+      ram[addr] = stack[-1]
+      return next_cp
+    return store
+
+  def _op_loadrb(self, _, next_cp):
+    ram = self.ram
+    def loadrb():
+      self._grow_ram(ram[REG_B])
+      ram[REG_B] = ram[ram[REG_B]]
+      return next_cp
+    return loadrb
+
+  def _op_storerb(self, _, next_cp):
+    stack = self.stack
+    ram = self.ram
+    def storerb():
+      self._grow_ram(ram[REG_B])
+      ram[ram[REG_B]] = stack[-1]
+      ram[REG_B] = 0
+      return next_cp
+    return storerb
+
+  def _op_jfz(self, target, next_cp):
+    stack = self.stack
+    def jfz():
+      return next_cp if stack[-1] else target
+    return jfz
+
+  def _op_jbnz(self, target, next_cp):
+    stack = self.stack
+    def jbnz():
+      return target if stack[-1] else next_cp
+    return jbnz
+
+  # with `profile`, memory accesses are counted first
+
+  def _op_profiled_load(self, addr, next_cp):
+    load = self._op_load(addr, next_cp)
+    def profiled_load():
+      self._count(addr)
+      return load()
+    return profiled_load
+
+  def _op_profiled_store(self, addr, next_cp):
+    store = self._op_store(addr, next_cp)
+    def profiled_store():
+      self._count(addr)
+      return store()
+    return profiled_store
+
+  def _op_profiled_loadrb(self, _, next_cp):
+    loadrb = self._op_loadrb(_, next_cp)
+    def profiled_loadrb():
+      self._count(self.ram[REG_B], True)
+      return loadrb()
+    return profiled_loadrb
+
+  def _op_profiled_storerb(self, _, next_cp):
+    storerb = self._op_storerb(_, next_cp)
+    def profiled_storerb():
+      self._count(self.ram[REG_B], True)
+      return storerb()
+    return profiled_storerb
 
 
 # Example, print "100" ten times
@@ -144,7 +387,8 @@ vars = {
   'a': 0
 }
 
-sm = StackMachine(code, vars, verbose=True)
-sm._run()
+if __name__ == '__main__':
+  sm = StackMachine(code, vars, verbose=True)
+  sm._run()
 
-print 'output', sm.output
\ No newline at end of file
+  print 'output', sm.output
\ No newline at end of file
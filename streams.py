@@ -0,0 +1,94 @@
+class NoInputLeft(Exception):
+  pass
+
+
+class InputStream(object):
+  """ Reads input values one at a time from a list, any iterator
+  or a binary file, keeping track of how many were consumed.
+
+  A `collections.deque` is read as a live queue: values appended to
+  it after the stream ran dry are still picked up.
+
+  Files are read `chunk_size` bytes at a time, every byte being one
+  value; use a `chunk_size` of 1 for interactive input. The first
+  `offset` values are skipped, e.g. when resuming a run.
+  """
+  def __init__(self, source, chunk_size=4096, offset=0):
+    self.source = source
+    self.offset = offset
+    self._queue = None
+
+    if hasattr(source, 'read'):
+      self._values = self._file_values(source, chunk_size)
+    elif hasattr(source, 'popleft'):
+      self._queue = source
+    else:
+      self._values = iter(source)
+
+    for _ in xrange(offset):
+      if self._queue is not None:
+        if self._queue:
+          self._queue.popleft()
+      else:
+        next(self._values, None)
+
+  def _file_values(self, f, chunk_size):
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        return
+      for value in bytearray(chunk):
+        yield value
+
+  def read(self):
+    if self._queue is not None:
+      if not self._queue:
+        raise NoInputLeft('no input left')
+      value = self._queue.popleft()
+    else:
+      try:
+        value = next(self._values)
+      except StopIteration:
+        raise NoInputLeft('no input left')
+    self.offset += 1
+    return value
+
+
+class OutputSink(object):
+  """ Buffers output values and passes them on to `target`, which
+  is either a binary file-like object (values are written as bytes)
+  or a callable taking a list of values.
+
+  The buffer is flushed every `flush_every` values; with `None`
+  it is only flushed when `flush` is called, which the machines
+  do at the end of every run.
+
+  The sink can be used wherever a plain output list is, through
+  `append` and `extend`.
+  """
+  def __init__(self, target, flush_every=None):
+    self.target = target
+    self.flush_every = flush_every
+    self.buffer = []
+    self.count = 0
+
+  def append(self, value):
+    self.buffer.append(value)
+    self.count += 1
+    if self.flush_every and len(self.buffer) >= self.flush_every:
+      self.flush()
+
+  def extend(self, values):
+    for value in values:
+      self.append(value)
+
+  def flush(self):
+    if not self.buffer:
+      return
+    values, self.buffer = self.buffer, []
+    if hasattr(self.target, 'write'):
+      self.target.write(bytes(bytearray(values)))
+      if hasattr(self.target, 'flush'):
+        self.target.flush()
+    else:
+      self.target(values)
@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+import unittest
+from collections import deque
+
+from bf import Brainfuck, WAITING_FOR_INPUT, scan_zero
+from bf_compiler import CompiledBrainfuck
+
+class ScanZeroTest(unittest.TestCase):
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_left_scan_starting_past_the_tape(self):
+    memory = bytearray(150)
+    memory[149] = 1
+    self.assertEqual(scan_zero(memory, 152, -3), 0)
+
+  def test_left_scan_loop_starting_past_the_tape(self):
+    code = '>' * 149 + '+' + '>' * 3 + '[<<<]'
+    for machine in (Brainfuck(code), CompiledBrainfuck(code, cache_dir=self.cache_dir)):
+      machine.run()
+      self.assertEqual(machine.pointer, 152)
+
+class RunCooperativeTest(unittest.TestCase):
+  def test_input_fed_one_value_at_a_time(self):
+    machine = Brainfuck(',,.')
+    machine.input = deque()
+    values = iter([3, 4, 5, 6])
+    for state in machine.run_cooperative():
+      if state == WAITING_FOR_INPUT:
+        machine.input.append(next(values))
+    self.assertEqual(machine.output, [4])
+    self.assertEqual(list(values), [5, 6])
+
+if __name__ == '__main__':
+  unittest.main()
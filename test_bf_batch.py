@@ -0,0 +1,23 @@
+import unittest
+
+from bf_batch import BatchBrainfuck, np
+from streams import NoInputLeft
+
+@unittest.skipIf(np is None, 'requires numpy')
+class BatchBrainfuckTest(unittest.TestCase):
+  def test_runs_every_input(self):
+    machine = BatchBrainfuck(',[->++<]>.', [[1], [0], [3]])
+    machine.run()
+    self.assertEqual(machine.outputs, [[2], [0], [6]])
+
+  def test_empty_batch(self):
+    machine = BatchBrainfuck(',>+.', [])
+    machine.run()
+    self.assertEqual(machine.outputs, [])
+
+  def test_running_out_of_input(self):
+    machine = BatchBrainfuck(',,.', [[1, 2], [1]])
+    self.assertRaises(NoInputLeft, machine.run)
+
+if __name__ == '__main__':
+  unittest.main()
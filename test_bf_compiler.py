@@ -0,0 +1,48 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from bf_compiler import CompiledBrainfuck, prepare_cache_dir
+
+CODE = '++++[->+++<]>.'
+
+class CacheDirTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def run_machine(self, cache_dir):
+    machine = CompiledBrainfuck(CODE, cache_dir=cache_dir)
+    machine.run()
+    return machine.output
+
+  def test_creates_a_private_directory(self):
+    cache_dir = os.path.join(self.root, 'cache')
+    self.assertTrue(prepare_cache_dir(cache_dir))
+    self.assertEqual(stat.S_IMODE(os.stat(cache_dir).st_mode), 0700)
+    self.assertEqual(self.run_machine(cache_dir), [12])
+    self.assertTrue(any(name.endswith('.marshal') for name in os.listdir(cache_dir)))
+
+  def test_ignores_a_directory_others_can_write_to(self):
+    cache_dir = os.path.join(self.root, 'shared')
+    os.mkdir(cache_dir)
+    os.chmod(cache_dir, 0777)
+    self.assertFalse(prepare_cache_dir(cache_dir))
+    self.assertEqual(self.run_machine(cache_dir), [12])
+    self.assertEqual(os.listdir(cache_dir), [])
+
+  def test_corrupt_entries_are_misses(self):
+    cache_dir = os.path.join(self.root, 'cache')
+    self.run_machine(cache_dir)
+    for name in os.listdir(cache_dir):
+      if name.endswith('.marshal'):
+        with open(os.path.join(cache_dir, name), 'wb') as f:
+          f.write('not marshal data')
+    self.assertEqual(self.run_machine(cache_dir), [12])
+
+if __name__ == '__main__':
+  unittest.main()
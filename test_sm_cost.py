@@ -0,0 +1,34 @@
+import unittest
+
+import lisp as L
+from bf import Brainfuck, PROFILE_ANNOTATIONS
+from brain_machine import sm_to_brainfuck
+from sm_cost import estimate
+
+class EstimateTest(unittest.TestCase):
+  def test_ifs_inside_a_loop_are_counted_once(self):
+    # a loop of 5 iterations, with two nested ifs that always run
+    code = L.blck(
+      L.assign(4, L.const(0)),
+      L.while_expr(
+        L.lt(L.load(4), L.const(5)),
+        L.blck(
+          L.if_expr(
+            L.gte(L.load(4), L.const(0)),
+            L.if_expr(
+              L.gte(L.load(4), L.const(0)),
+              L.assign(5, L.add(L.load(5), L.const(2))))),
+          L.assign(4, L.add(L.load(4), L.const(1))))),
+      L.prnt(L.load(5)))
+
+    machine = Brainfuck(sm_to_brainfuck(code, 2, 4), profile=PROFILE_ANNOTATIONS)
+    machine.run()
+    self.assertEqual(machine.output, [10])
+    steps = sum(machine.execution_log)
+
+    report = estimate(code, 2, 4, ranges={4: (0, 5), 5: (0, 10)}, loop_iterations=5)
+    self.assertEqual(max(report['levels']), 1)
+    self.assertTrue(report['steps_low'] <= steps <= report['steps_high'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from sm_optimizer import eliminate_common_subexpressions, fold_constants
+from stack_machine import StackMachine
+
+def run(sm_code, input=()):
+  machine = StackMachine(sm_code, verbose=False, input=list(input))
+  machine.run()
+  return machine.output
+
+class FoldConstantsTest(unittest.TestCase):
+  def test_keeps_stores_below_a_popped_side_effect(self):
+    code = [
+      ('push', 1), ('push', 2), ('store', 10), ('pop', None), ('pop', None),
+      ('read', None), ('store', 1), ('pop', None), ('loadrb', None), ('load', 1),
+      ('prnt', None), ('pop', None)
+    ]
+    self.assertEqual(run(code, [10]), [2])
+    self.assertEqual(run(fold_constants(code), [10]), [2])
+
+class EliminateCommonSubexpressionsTest(unittest.TestCase):
+  def test_stores_a_value_once_for_all_repeats(self):
+    load_5 = [('push', 5), ('store', 1), ('pop', None), ('loadrb', None), ('load', 1)]
+    code = [('push', 7), ('store', 5), ('pop', None)] + \
+           load_5 + load_5 + load_5 + [('add', None), ('add', None), ('prnt', None), ('pop', None)]
+    optimized = eliminate_common_subexpressions(code)
+    self.assertEqual(run(optimized), [21])
+    self.assertEqual(len([instr for instr in optimized if instr == ('store', 2)]), 1)
+    self.assertEqual(len([instr for instr in optimized if instr == ('load', 2)]), 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+import lisp
+from bf import Brainfuck, PROFILE_ANNOTATIONS
+from brain_machine import REGISTERS, sm_to_brainfuck
+from sm_placement import access_counts, place_variables
+
+def run(sm_code):
+  machine = Brainfuck(sm_to_brainfuck(sm_code, len(lisp.addr)), profile=PROFILE_ANNOTATIONS)
+  machine.run()
+  return machine
+
+class PlaceVariablesTest(unittest.TestCase):
+  def test_hot_pointers_go_next_to_reg_a(self):
+    machine = run(lisp.bf_in_bf_code)
+    code, mapping = place_variables(lisp.bf_in_bf_code, access_counts(machine))
+
+    nearest = set([mapping[lisp.a('p_ptr')], mapping[lisp.a('curr_instr')]])
+    self.assertEqual(nearest, set([REGISTERS, REGISTERS + 1]))
+    self.assertEqual(run(code).output, machine.output)
+
+if __name__ == '__main__':
+  unittest.main()